@@ -1,10 +1,19 @@
+import asyncio
+import hashlib
 import json
 import logging
 import os
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from typing import List, Optional, Tuple
 
+import ciso8601
 from aiohttp import web
 
-from pluralkit import db, utils
+from pluralkit import db, stats, utils
+from pluralkit.api.ratelimit import RateLimit, add_rate_limit_headers, client_keys, rate_limit_middleware
+from pluralkit.api.streams import SystemStreamHub
+from pluralkit.cache import SizedLRUCache, TTLCache
 from pluralkit.errors import PluralKitError
 from pluralkit.member import Member
 from pluralkit.system import System
@@ -12,6 +21,53 @@ from pluralkit.system import System
 logging.basicConfig(level=logging.INFO, format="[%(asctime)s] [%(name)s] [%(levelname)s] %(message)s")
 logger = logging.getLogger("pluralkit.api")
 
+# Default and maximum number of switches returned per page by /systems/{id}/switches
+SWITCH_PAGE_SIZE = 100
+SWITCH_PAGE_SIZE_MAX = 1000
+
+# Switches read per query when streaming the full history (?stream=true)
+SWITCH_STREAM_PAGE_SIZE = 500
+
+# Default and maximum number of results returned by /systems/{id}/members/search
+MEMBER_SEARCH_LIMIT = 10
+MEMBER_SEARCH_LIMIT_MAX = 50
+
+# Maximum number of IDs accepted by the batch endpoints (/systems?ids=... and /members?ids=...)
+BATCH_SIZE_MAX = 100
+
+# System hids never change, so this mapping only goes stale when a system is deleted
+system_id_cache = TTLCache(ttl=60 * 60)
+
+# Current fronters and switch time by system ID. Switches made through the API invalidate this directly,
+# ones made elsewhere (eg. by the bot) through the invalidation bus. The TTL is a fallback in case notifications get lost
+FRONTER_CACHE_TTL = 60
+fronter_cache = TTLCache(ttl=FRONTER_CACHE_TTL)
+
+# Systems by API token hash, and the reverse, so entries can be dropped when a system's token is refreshed
+# or the system is deleted (both announced as system invalidations)
+TOKEN_CACHE_TTL = 60
+token_cache = TTLCache(ttl=TOKEN_CACHE_TTL)
+token_hash_by_system = TTLCache(ttl=TOKEN_CACHE_TTL)
+
+# Encoded JSON bodies of systems and members, keyed by (type, ID) and checked against the ETag of the current version
+response_cache = SizedLRUCache(max_bytes=int(os.environ.get("API_RESPONSE_CACHE_BYTES") or 64 * 1024 * 1024))
+
+# Limits on open switch event streams (/systems/{id}/switch/events) in total, per system, and per client IP and token,
+# and how often to send a keepalive comment down idle ones
+STREAM_MAX_CONNECTIONS = int(os.environ.get("API_STREAM_MAX_CONNECTIONS") or 1000)
+STREAM_MAX_CONNECTIONS_PER_SYSTEM = int(os.environ.get("API_STREAM_MAX_CONNECTIONS_PER_SYSTEM") or 10)
+STREAM_MAX_CONNECTIONS_PER_CLIENT = int(os.environ.get("API_STREAM_MAX_CONNECTIONS_PER_CLIENT") or 5)
+STREAM_PING_INTERVAL = 30
+
+# Header a trusted reverse proxy puts the client IP in, see client_ip
+CLIENT_IP_HEADER = os.environ.get("API_CLIENT_IP_HEADER")
+
+# Requests allowed per client IP and per token, by route class (see rate_limit_class)
+RATE_LIMITS = {
+    "read": RateLimit.from_env("API_RATE_LIMIT_READ", "120/60"),
+    "write": RateLimit.from_env("API_RATE_LIMIT_WRITE", "10/60")
+}
+
 
 def db_handler(f):
     async def inner(request, *args, **kwargs):
@@ -21,6 +77,21 @@ def db_handler(f):
     return inner
 
 
+async def get_system_by_token_cached(conn, token: str) -> Optional[System]:
+    token_hash = utils.hash_token(token)
+
+    missing = object()
+    system = token_cache.get(token_hash, missing)
+    if system is missing:
+        system = await System.get_by_token(conn, token)
+
+        # Unknown tokens are cached too, so retrying a bad one doesn't hit the database every time
+        token_cache.set(token_hash, system)
+        if system:
+            token_hash_by_system.set(system.id, token_hash)
+    return system
+
+
 def system_auth(f):
     async def inner(request: web.Request, conn, *args, **kwargs):
         token = request.headers.get("X-Token")
@@ -30,7 +101,7 @@ def system_auth(f):
         if not token:
             raise web.HTTPUnauthorized()
 
-        system = await System.get_by_token(conn, token)
+        system = await get_system_by_token_cached(conn, token)
         if not system:
             raise web.HTTPUnauthorized()
 
@@ -39,95 +110,454 @@ def system_auth(f):
     return inner
 
 
+def make_etag(*parts) -> str:
+    """Builds a strong ETag out of whatever identifies a version of a resource."""
+    digest = hashlib.sha1("/".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+    return "\"{}\"".format(digest[:20])
+
+
+def caching_headers(etag: str, last_modified: Optional[datetime] = None) -> dict:
+    # Clients may keep a copy, but have to revalidate it every time (which is what the ETag is for)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if last_modified:
+        headers["Last-Modified"] = format_datetime(last_modified.replace(tzinfo=timezone.utc), usegmt=True)
+    return headers
+
+
+def check_not_modified(request: web.Request, etag: str, last_modified: Optional[datetime] = None):
+    """Raises 304 Not Modified if the client's copy (according to If-None-Match or If-Modified-Since) is still current."""
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        if "*" in tags or etag in tags or "W/" + etag in tags:
+            raise web.HTTPNotModified(headers=caching_headers(etag, last_modified))
+    elif last_modified and request.if_modified_since:
+        # HTTP dates only have second precision
+        if last_modified.replace(tzinfo=timezone.utc, microsecond=0) <= request.if_modified_since:
+            raise web.HTTPNotModified(headers=caching_headers(etag, last_modified))
+
+
 @db_handler
 async def get_system(request: web.Request, conn):
-    system = await db.get_system_by_hid(conn, request.match_info["id"])
-
-    if not system:
+    # Check the (cheap) version first, so clients with a current copy don't cost a full fetch
+    version = await db.get_system_version(conn, request.match_info["id"])
+    if not version:
         raise web.HTTPNotFound()
 
-    members = await db.get_all_members(conn, system.id)
+    etag = make_etag("system", version.id, version.updated.isoformat())
+    check_not_modified(request, etag, version.updated)
+
+    body = response_cache.get(("system", version.id), etag)
+    if not body:
+        system = await db.get_system(conn, version.id)
+        if not system:
+            raise web.HTTPNotFound()
+
+        members = await db.get_all_members(conn, system.id)
+
+        system_json = system.to_json()
+        system_json["members"] = [member.to_json() for member in members]
 
-    system_json = system.to_json()
-    system_json["members"] = [member.to_json() for member in members]
-    return web.json_response(system_json)
+        body = json.dumps(system_json).encode("utf-8")
+        response_cache.set(("system", version.id), etag, body)
+
+    return web.Response(body=body, content_type="application/json", headers=caching_headers(etag, version.updated))
 
 
 @db_handler
 async def get_member(request: web.Request, conn):
-    member = await db.get_member_by_hid(conn, request.match_info["id"])
-
-    if not member:
+    version = await db.get_member_version(conn, request.match_info["id"])
+    if not version:
         raise web.HTTPNotFound()
 
-    return web.json_response(member.to_json())
+    member_id, updated = version
+    etag = make_etag("member", member_id, updated.isoformat())
+    check_not_modified(request, etag, updated)
+
+    body = response_cache.get(("member", member_id), etag)
+    if not body:
+        member = await db.get_member(conn, member_id)
+        if not member:
+            raise web.HTTPNotFound()
+
+        body = json.dumps(member.to_json()).encode("utf-8")
+        response_cache.set(("member", member_id), etag, body)
+
+    return web.Response(body=body, content_type="application/json", headers=caching_headers(etag, updated))
+
+
+def parse_ids_param(request: web.Request) -> List[str]:
+    """Parses the comma-separated `ids` query parameter of the batch endpoints, dropping duplicates."""
+    ids = []
+    for hid in request.query.get("ids", "").split(","):
+        hid = hid.strip()
+        if hid and hid not in ids:
+            ids.append(hid)
+
+    if not ids:
+        raise web.HTTPBadRequest(body="Missing 'ids'")
+    if len(ids) > BATCH_SIZE_MAX:
+        raise web.HTTPBadRequest(body="Too many IDs (at most {} per request)".format(BATCH_SIZE_MAX))
+    return ids
 
 
 @db_handler
-async def get_switches(request: web.Request, conn):
-    system = await db.get_system_by_hid(conn, request.match_info["id"])
+async def get_systems(request: web.Request, conn):
+    system_hids = parse_ids_param(request)
+    systems = {system.hid: system for system in await db.get_systems_by_hids(conn, system_hids)}
+
+    members_by_system = {system.id: [] for system in systems.values()}
+    if systems:
+        for member in await db.get_members_of_systems(conn, list(members_by_system.keys())):
+            members_by_system[member.system].append(member)
+
+    systems_json = []
+    for hid in system_hids:
+        if hid in systems:
+            system_json = systems[hid].to_json()
+            system_json["members"] = [member.to_json() for member in members_by_system[systems[hid].id]]
+            systems_json.append(system_json)
+
+    # Unknown IDs are reported instead of failing the whole request
+    return web.json_response({
+        "systems": systems_json,
+        "missing": [hid for hid in system_hids if hid not in systems]
+    })
+
+
+@db_handler
+async def get_members(request: web.Request, conn):
+    member_hids = parse_ids_param(request)
+    members = {member.hid: member for member in await db.get_members_by_hids(conn, member_hids)}
+
+    return web.json_response({
+        "members": [members[hid].to_json() for hid in member_hids if hid in members],
+        "missing": [hid for hid in member_hids if hid not in members]
+    })
+
 
+@db_handler
+async def search_members(request: web.Request, conn):
+    query = request.query.get("q", "").strip()
+    if not query:
+        raise web.HTTPBadRequest(body="Missing 'q'")
+
+    try:
+        limit = max(1, min(int(request.query.get("limit", MEMBER_SEARCH_LIMIT)), MEMBER_SEARCH_LIMIT_MAX))
+    except ValueError:
+        raise web.HTTPBadRequest(body="Invalid limit")
+
+    if not db.has_pg_trgm:
+        raise web.HTTPNotImplemented(body="Member search is not available on this server")
+
+    system = await db.get_system_by_hid(conn, request.match_info["id"])
     if not system:
         raise web.HTTPNotFound()
 
-    switches = await utils.get_front_history(conn, system.id, 99999)
+    results = await Member.search(conn, system.id, query, limit)
+    return web.json_response([dict(member.to_json(), score=round(score, 3)) for member, score in results])
+
 
-    data = [{
+def switch_to_json(stamp: datetime, members: List[Member]):
+    return {
         "timestamp": stamp.isoformat(),
         "members": [member.hid for member in members]
-    } for stamp, members in switches]
+    }
+
+
+async def get_switches(request: web.Request):
+    # Not a db_handler, since streamed responses take connections page by page instead of holding one throughout
+    async with request.app["pool"].acquire() as conn:
+        version = await db.get_system_version(conn, request.match_info["id"])
+        if not version:
+            raise web.HTTPNotFound()
+
+        # Only the latest switch can be moved or deleted, and deleting members (which removes them from switches) touches the system
+        etag = make_etag("switches", version.id, version.updated.isoformat(), version.current_switch,
+                         version.switch_timestamp.isoformat() if version.switch_timestamp else None)
+        check_not_modified(request, etag)
+
+        start = parse_time_param(request, "from")
+        end = parse_time_param(request, "to")
+
+        if not parse_bool_param(request, "stream"):
+            return await get_switch_page(request, conn, version.id, etag, start, end)
+
+    return await stream_switches(request, version.id, etag, start, end)
+
+
+async def get_switch_page(request: web.Request, conn, system_id: int, etag: str, start: Optional[datetime], end: Optional[datetime]):
+    try:
+        limit = max(1, min(int(request.query.get("limit", SWITCH_PAGE_SIZE)), SWITCH_PAGE_SIZE_MAX))
+    except ValueError:
+        raise web.HTTPBadRequest(body="Invalid limit")
+
+    before, before_id = parse_cursor_param(request, "before")
+    switches = await db.front_history_with_members(conn, system_id, limit, before, start, end, before_id)
+
+    response = web.json_response([switch_to_json(switch.timestamp, members) for switch, members in switches],
+                                 headers=caching_headers(etag))
+
+    # Full page, so there might be more - point at the next one
+    if len(switches) == limit:
+        last_switch = switches[-1][0]
+        next_url = request.rel_url.update_query(before="{},{}".format(last_switch.timestamp.isoformat(), last_switch.id))
+        response.headers["Link"] = "<{}>; rel=\"next\"".format(next_url)
+    return response
+
+
+async def stream_switches(request: web.Request, system_id: int, etag: str, start: Optional[datetime], end: Optional[datetime]):
+    """
+    Writes out the whole switch history as one JSON array, piece by piece.
+
+    It's read in pages through the same keyset query as paginated requests, with a connection taken from the pool for
+    each page and given back before the page is written, so slow clients only ever hold up themselves.
+    """
+    response = web.StreamResponse(headers=caching_headers(etag))
+    response.content_type = "application/json"
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+
+    await response.write(b"[")
+    first = True
+    before, before_id = None, None
+    while True:
+        async with request.app["pool"].acquire() as conn:
+            switches = await db.front_history_with_members(conn, system_id, SWITCH_STREAM_PAGE_SIZE, before, start, end,
+                                                           before_id)
+        if switches is None:
+            # The status has long been sent, so all that's left is cutting the response short (the error's been logged)
+            raise ConnectionResetError("Error reading switch history")
+
+        for switch, members in switches:
+            await response.write((b"" if first else b",") + json.dumps(switch_to_json(switch.timestamp, members)).encode("utf-8"))
+            first = False
+
+        if len(switches) < SWITCH_STREAM_PAGE_SIZE:
+            break
+        before, before_id = switches[-1][0].timestamp, switches[-1][0].id
+    await response.write(b"]")
+
+    await response.write_eof()
+    return response
+
+
+def parse_time_param(request: web.Request, name: str) -> Optional[datetime]:
+    """Parses an ISO-8601 query parameter into a naive UTC datetime (as used throughout PluralKit)."""
+    value = request.query.get(name)
+    if not value:
+        return None
+
+    try:
+        return parse_timestamp(value)
+    except ValueError:
+        raise web.HTTPBadRequest(body="Invalid timestamp for '{}'".format(name))
+
+
+def parse_timestamp(value: str) -> datetime:
+    parsed = ciso8601.parse_datetime(value)
+    if parsed.tzinfo:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def parse_cursor_param(request: web.Request, name: str) -> Tuple[Optional[datetime], Optional[int]]:
+    """Parses a pagination cursor of `<timestamp>,<switch ID>` (or just a timestamp) into its parts."""
+    value = request.query.get(name)
+    if not value:
+        return None, None
 
-    return web.json_response(data)
+    timestamp, _, switch_id = value.rpartition(",")
+    try:
+        if not timestamp:
+            return parse_timestamp(value), None
+        return parse_timestamp(timestamp), int(switch_id)
+    except ValueError:
+        raise web.HTTPBadRequest(body="Invalid cursor for '{}'".format(name))
+
+
+def parse_bool_param(request: web.Request, name: str) -> bool:
+    value = request.query.get(name, "").lower()
+    if value in ("", "0", "false", "no", "off"):
+        return False
+    if value in ("1", "true", "yes", "on"):
+        return True
+    raise web.HTTPBadRequest(body="Invalid value for '{}', expected true or false".format(name))
+
+
+@db_handler
+async def get_frontpercent(request: web.Request, conn):
+    system = await db.get_system_by_hid(conn, request.match_info["id"])
+
+    if not system:
+        raise web.HTTPNotFound()
+
+    since = parse_time_param(request, "since") or datetime.utcnow() - timedelta(days=30)
+    breakdown = await utils.get_front_breakdown(conn, system.id, since)
+    if not breakdown:
+        # No switch has been registered at all
+        raise web.HTTPNotFound()
+
+    return web.json_response(breakdown.to_json())
 
 
 @db_handler
 async def get_message(request: web.Request, conn):
-    message = await db.get_message(conn, request.match_info["id"])
+    try:
+        message_id = int(request.match_info["id"])
+    except ValueError:
+        raise web.HTTPNotFound()
+
+    # Messages past the retention horizon are treated as nonexistent
+    message = await db.get_message(conn, message_id)
     if not message:
         raise web.HTTPNotFound()
 
     return web.json_response(message.to_json())
 
 
-@db_handler
-async def get_switch(request: web.Request, conn):
-    system = await db.get_system_by_hid(conn, request.match_info["id"])
+async def get_cached_fronters(request: web.Request) -> Optional[Tuple[List[Member], Optional[datetime]]]:
+    """
+    Returns the current fronters and switch time of the system given in the URL, or None if the system doesn't exist.
 
-    if not system:
+    Served from the fronter cache where possible, and only touches the database pool on a cache miss.
+    """
+    system_hid = request.match_info["id"]
+    system_id = system_id_cache.get(system_hid)
+
+    fronters = fronter_cache.get(system_id) if system_id else None
+    if fronters:
+        return fronters
+
+    async with request.app["pool"].acquire() as conn:
+        if not system_id:
+            system = await db.get_system_by_hid(conn, system_hid)
+            if not system:
+                return None
+
+            system_id = system.id
+            system_id_cache.set(system_hid, system_id)
+
+        fronters = await utils.get_fronters(conn, system_id)
+
+    fronter_cache.set(system_id, fronters)
+    return fronters
+
+
+def fronters_etag(fronters: Tuple[List[Member], Optional[datetime]]) -> str:
+    # Computed from the (cached) fronters themselves, so revalidating doesn't need the database at all
+    members, stamp = fronters
+    return make_etag("fronters", stamp.isoformat() if stamp else None,
+                     *["{}@{}".format(member.id, member.updated.isoformat()) for member in members])
+
+
+async def get_switch(request: web.Request):
+    fronters = await get_cached_fronters(request)
+
+    if not fronters:
         raise web.HTTPNotFound()
 
-    members, stamp = await utils.get_fronters(conn, system.id)
+    members, stamp = fronters
     if not stamp:
         # No switch has been registered at all
         raise web.HTTPNotFound()
 
+    etag = fronters_etag(fronters)
+    check_not_modified(request, etag)
+
     data = {
         "timestamp": stamp.isoformat(),
         "members": [member.to_json() for member in members]
     }
-    return web.json_response(data)
+    return web.json_response(data, headers=caching_headers(etag))
 
 
-@db_handler
-async def get_switch_name(request: web.Request, conn):
-    system = await db.get_system_by_hid(conn, request.match_info["id"])
+async def get_switch_name(request: web.Request):
+    fronters = await get_cached_fronters(request)
 
-    if not system:
+    if not fronters:
         raise web.HTTPNotFound()
 
-    members, stamp = await utils.get_fronters(conn, system.id)
-    return web.Response(text=members[0].name if members else "(nobody)")
+    etag = fronters_etag(fronters)
+    check_not_modified(request, etag)
 
+    members, stamp = fronters
+    return web.Response(text=members[0].name if members else "(nobody)", headers=caching_headers(etag))
 
-@db_handler
-async def get_switch_color(request: web.Request, conn):
-    system = await db.get_system_by_hid(conn, request.match_info["id"])
 
+async def get_switch_color(request: web.Request):
+    fronters = await get_cached_fronters(request)
+
+    if not fronters:
+        raise web.HTTPNotFound()
+
+    etag = fronters_etag(fronters)
+    check_not_modified(request, etag)
+
+    members, stamp = fronters
+    return web.Response(text=members[0].color if members else "#ffffff", headers=caching_headers(etag))
+
+
+def format_event(event: str, data) -> bytes:
+    return "event: {}\ndata: {}\n\n".format(event, json.dumps(data)).encode("utf-8")
+
+
+async def render_switch_event(system_id: int, event_type: str) -> bytes:
+    # Rendered once per event for all of the system's streams, which also leaves the fresh fronters in the cache
+    async with app["pool"].acquire() as conn:
+        fronters = await utils.get_fronters(conn, system_id)
+    fronter_cache.set(system_id, fronters)
+
+    members, stamp = fronters
+    return format_event("switch", {
+        "type": event_type,
+        "timestamp": stamp.isoformat() if stamp else None,
+        "members": [member.to_json() for member in members]
+    })
+
+
+async def get_switch_events(request: web.Request):
+    """
+    Streams the system's current fronters as Server-Sent Events, starting with the current state (type "sync") and
+    then again whenever a switch is added, moved or deleted (type "added", "moved" or "deleted").
+    """
+    async with request.app["pool"].acquire() as conn:
+        system = await db.get_system_by_hid(conn, request.match_info["id"])
     if not system:
         raise web.HTTPNotFound()
 
-    members, stamp = await utils.get_fronters(conn, system.id)
-    return web.Response(text=members[0].color if members else "#ffffff")
+    hub = request.app["switch_streams"]
+    keys = client_keys(request, CLIENT_IP_HEADER)
+    subscriber = hub.subscribe(system.id, keys)
+    if not subscriber:
+        if hub.client_at_limit(keys):
+            raise web.HTTPTooManyRequests(body="Too many open streams from this client",
+                                          headers={"Retry-After": str(STREAM_PING_INTERVAL)})
+        raise web.HTTPServiceUnavailable(body="Too many open streams", headers={"Retry-After": str(STREAM_PING_INTERVAL)})
+
+    try:
+        response = web.StreamResponse(headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+        response.content_type = "text/event-stream"
+        await response.prepare(request)
+
+        # Subscribed first, so nothing happening in between gets lost
+        await response.write(await render_switch_event(system.id, "sync"))
+        while True:
+            try:
+                data = await asyncio.wait_for(subscriber.queue.get(), timeout=STREAM_PING_INTERVAL)
+            except asyncio.TimeoutError:
+                await response.write(b": ping\n\n")
+                continue
+
+            # The client fell too far behind, see SystemStreamHub
+            if data is None:
+                break
+            await response.write(data)
+    finally:
+        hub.unsubscribe(system.id, subscriber)
+
+    await response.write_eof()
+    return response
 
 
 @db_handler
@@ -154,20 +584,13 @@ async def put_switch(request: web.Request, system: System, conn):
         members.append(member)
 
     switch = await system.add_switch(conn, members)
+    fronter_cache.invalidate(system.id)
     return web.json_response(await switch.to_json(conn))
 
 
-@db_handler
-async def get_stats(request: web.Request, conn):
-    system_count = await db.system_count(conn)
-    member_count = await db.member_count(conn)
-    message_count = await db.message_count(conn)
-
-    return web.json_response({
-        "systems": system_count,
-        "members": member_count,
-        "messages": message_count
-    })
+async def get_stats(request: web.Request):
+    # Served from memory, see StatsCache for how often this gets refreshed
+    return web.json_response(request.app["stats"].to_json())
 
 
 @web.middleware
@@ -178,28 +601,115 @@ async def render_pk_errors(request, handler):
         raise web.HTTPBadRequest(body=e.message)
 
 
-app = web.Application(middlewares=[render_pk_errors])
+def rate_limit_class(request: web.Request) -> str:
+    # Writes (ie. registering switches) are far more expensive than reads, most of which are served from cache
+    return "read" if request.method in ("GET", "HEAD") else "write"
+
+
+app = web.Application(middlewares=[
+    rate_limit_middleware(RATE_LIMITS, rate_limit_class, forwarded_header=CLIENT_IP_HEADER),
+    render_pk_errors
+])
+app.on_response_prepare.append(add_rate_limit_headers)
 app.add_routes([
+    web.get("/systems", get_systems),
     web.get("/systems/{id}", get_system),
     web.get("/systems/{id}/switches", get_switches),
     web.get("/systems/{id}/switch", get_switch),
     web.put("/systems/{id}/switch", put_switch),
     web.get("/systems/{id}/switch/name", get_switch_name),
     web.get("/systems/{id}/switch/color", get_switch_color),
+    web.get("/systems/{id}/switch/events", get_switch_events),
+    web.get("/systems/{id}/frontpercent", get_frontpercent),
+    web.get("/systems/{id}/members/search", search_members),
+    web.get("/members", get_members),
     web.get("/members/{id}", get_member),
     web.get("/messages/{id}", get_message),
     web.get("/stats", get_stats)
 ])
 
 
+def invalidate_fronters(system_id: Optional[int]):
+    if system_id:
+        fronter_cache.invalidate(system_id)
+    else:
+        fronter_cache.clear()
+
+
+def invalidate_system_ids(system_id: Optional[int]):
+    # Entries are keyed by hid, so a specific system can't be looked up - only full resyncs are handled
+    # (a deleted system's stale entry just resolves to no fronters until it expires)
+    if not system_id:
+        system_id_cache.clear()
+
+
+def invalidate_response(entity: str):
+    def invalidator(entity_id: Optional[int]):
+        if entity_id:
+            response_cache.invalidate((entity, entity_id))
+        else:
+            response_cache.clear()
+    return invalidator
+
+
+db.register_invalidator("system", invalidate_response("system"))
+db.register_invalidator("member", invalidate_response("member"))
+
+
+def invalidate_tokens(system_id: Optional[int]):
+    if system_id:
+        token_hash = token_hash_by_system.get(system_id)
+        if token_hash:
+            token_cache.invalidate(token_hash)
+            token_hash_by_system.invalidate(system_id)
+    else:
+        token_cache.clear()
+        token_hash_by_system.clear()
+
+
+db.register_invalidator("system", invalidate_tokens)
+db.register_invalidator("switch", invalidate_fronters)
+# Fronter lists include member details, and those changing is announced on the system
+db.register_invalidator("system", invalidate_fronters)
+db.register_invalidator("system", invalidate_system_ids)
+
+
+def notify_switch_streams(event: db.SwitchEvent):
+    hub = app.get("switch_streams")
+    if hub:
+        hub.notify(event.system, event.type)
+
+
+def resync_switch_streams(system_id: Optional[int]):
+    # Switch events may have been missed while the listener was disconnected
+    hub = app.get("switch_streams")
+    if hub and not system_id:
+        hub.notify(None, "sync")
+
+
+db.register_switch_event_handler(notify_switch_streams)
+db.register_invalidator("switch", resync_switch_streams)
+
+
 async def run():
-    app["pool"] = await db.connect(
+    credentials = (
         os.environ["DATABASE_USER"],
         os.environ["DATABASE_PASS"],
         os.environ["DATABASE_NAME"],
         os.environ["DATABASE_HOST"],
         int(os.environ["DATABASE_PORT"])
     )
+    app["pool"] = await db.connect(*credentials)
+    asyncio.get_event_loop().create_task(db.listen_for_invalidations(*credentials))
+
+    app["switch_streams"] = SystemStreamHub(render_switch_event, max_streams=STREAM_MAX_CONNECTIONS,
+                                            max_streams_per_system=STREAM_MAX_CONNECTIONS_PER_SYSTEM,
+                                            max_streams_per_client=STREAM_MAX_CONNECTIONS_PER_CLIENT)
+    asyncio.get_event_loop().create_task(app["switch_streams"].run())
+
+    app["stats"] = stats.StatsCache(app["pool"])
+    await app["stats"].refresh(exact=True)
+    asyncio.get_event_loop().create_task(app["stats"].run())
     return app
 
 
@@ -0,0 +1,74 @@
+"""
+Measures the wall-clock time it takes to build system, member and message cards against a real database and
+Discord API, both with an empty user cache (cold) and a filled one (warm).
+
+Needs the same DATABASE_* and TOKEN environment variables as the bot (the bot only logs in over HTTP, it doesn't
+connect to the gateway).
+
+Usage (from the src directory): python -m benchmarks.cards <system hid> [message id] [rounds]
+"""
+import asyncio
+import os
+import sys
+import time
+
+import discord
+
+from pluralkit import db
+from pluralkit.bot import embeds, get_database_credentials, utils
+
+
+async def measure(name: str, build, rounds: int):
+    cold = []
+    warm = []
+    for _ in range(rounds):
+        utils.user_cache.clear()
+        before = time.perf_counter()
+        await build()
+        cold.append(time.perf_counter() - before)
+
+        before = time.perf_counter()
+        await build()
+        warm.append(time.perf_counter() - before)
+
+    print("{:<8} cold {:8.2f} ms   warm {:8.2f} ms".format(
+        name, sum(cold) / rounds * 1000, sum(warm) / rounds * 1000))
+
+
+async def main():
+    if len(sys.argv) < 2:
+        print(__doc__.strip(), file=sys.stderr)
+        sys.exit(1)
+
+    system_hid = sys.argv[1]
+    message_id = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    rounds = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+
+    pool = await db.connect(**get_database_credentials())
+    client = discord.Client()
+    await client.login(os.environ["TOKEN"])
+
+    try:
+        async with pool.acquire() as conn:
+            system = await db.get_system_by_hid(conn, system_hid)
+            if not system:
+                print("No system with ID {}".format(system_hid), file=sys.stderr)
+                sys.exit(1)
+
+            await measure("system", lambda: embeds.system_card(conn, client, system), rounds)
+
+            members = await system.get_members(conn)
+            if members:
+                await measure("member", lambda: embeds.member_card(conn, members[0]), rounds)
+
+            if message_id:
+                message = await db.get_message(conn, message_id)
+                if message:
+                    await measure("message", lambda: embeds.message_card(client, message), rounds)
+    finally:
+        await client.logout()
+        await pool.close()
+
+
+if __name__ == "__main__":
+    asyncio.get_event_loop().run_until_complete(main())
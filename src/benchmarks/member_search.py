@@ -0,0 +1,88 @@
+"""
+Measures the latency of fuzzy member search (db.search_members) and exact name lookups on a synthetic system.
+
+Creates a system with the given number of randomly named members inside a transaction that's rolled back
+afterwards, so nothing is left behind - but run this against a development database all the same.
+Needs the same DATABASE_* environment variables as the bot.
+
+Usage (from the src directory): python -m benchmarks.member_search [member count] [queries]
+"""
+import asyncio
+import random
+import string
+import sys
+import time
+
+from pluralkit import db
+from pluralkit.bot import get_database_credentials
+
+SYLLABLES = ["ka", "ri", "mo", "len", "sa", "tho", "vi", "ar", "el", "nyx", "qu", "ro", "ash", "ly", "dan", "ez"]
+
+
+def random_name() -> str:
+    words = ["".join(random.choice(SYLLABLES) for _ in range(random.randint(2, 4))) for _ in range(random.randint(1, 2))]
+    return " ".join(word.capitalize() for word in words)
+
+
+def misspell(name: str) -> str:
+    # Drops, swaps or replaces a character, like a typo would
+    i = random.randrange(len(name))
+    action = random.choice(["drop", "swap", "replace"])
+    if action == "drop":
+        return name[:i] + name[i + 1:]
+    if action == "swap" and i < len(name) - 1:
+        return name[:i] + name[i + 1] + name[i] + name[i + 2:]
+    return name[:i] + random.choice(string.ascii_lowercase) + name[i + 1:]
+
+
+def report(name: str, timings):
+    timings = sorted(timings)
+    print("{:<10} p50 {:7.2f} ms   p95 {:7.2f} ms   max {:7.2f} ms".format(
+        name, timings[len(timings) // 2] * 1000, timings[int(len(timings) * 0.95)] * 1000, timings[-1] * 1000))
+
+
+async def main():
+    member_count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    query_count = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    names = [random_name() for _ in range(member_count)]
+    hids = set()
+    while len(hids) < member_count:
+        hids.add("".join(random.choice(string.ascii_lowercase) for _ in range(5)))
+
+    pool = await db.connect(**get_database_credentials())
+    async with pool.acquire() as conn:
+        transaction = conn.transaction()
+        await transaction.start()
+        try:
+            system_id = await conn.fetchval("insert into systems (hid) values ('zzzzz') returning id")
+            await conn.execute("insert into members (system, hid, name) select $1, * from unnest($2::char(5)[], $3::text[])",
+                               system_id, list(hids), names)
+            await conn.execute("analyze members")
+
+            searches = []
+            lookups = []
+            hits = 0
+            for _ in range(query_count):
+                name = random.choice(names)
+
+                before = time.perf_counter()
+                results = await db.search_members(conn, system_id, misspell(name), 10)
+                searches.append(time.perf_counter() - before)
+                hits += any(member.name == name for member, _ in results)
+
+                before = time.perf_counter()
+                await db.get_member_by_name(conn, system_id, name)
+                lookups.append(time.perf_counter() - before)
+
+            print("{} members, {} queries, intended member suggested for {:.1f}% of typos".format(
+                member_count, query_count, hits / query_count * 100))
+            report("search", searches)
+            report("exact", lookups)
+        finally:
+            await transaction.rollback()
+    await pool.close()
+
+
+if __name__ == "__main__":
+    asyncio.get_event_loop().run_until_complete(main())
@@ -0,0 +1,56 @@
+"""
+Measures the CPU cost per MESSAGE_CREATE event with and without the raw message filter (pluralkit.bot.gateway).
+
+Payloads are recorded by running the bot with MESSAGE_PAYLOAD_RECORD_FILE set. Registered accounts can be given as
+a file with one account ID per line (eg. the output of `select uid from accounts`); otherwise only messages that
+look like commands count as candidates.
+
+Usage (from the src directory): python -m benchmarks.message_filter <payloads.jsonl> [accounts.txt] [rounds]
+"""
+import json
+import sys
+import time
+
+import discord
+
+from pluralkit.bot import gateway
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__.strip(), file=sys.stderr)
+        sys.exit(1)
+
+    with open(sys.argv[1]) as f:
+        payloads = [json.loads(line) for line in f if line.strip()]
+
+    accounts = gateway.RegisteredAccounts(None)
+    accounts.loaded = True
+    if len(sys.argv) > 2:
+        with open(sys.argv[2]) as f:
+            accounts.account_ids = {int(line) for line in f if line.strip()}
+    rounds = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+
+    def run(client: discord.Client) -> float:
+        parse = client._connection.parsers["MESSAGE_CREATE"]
+        before = time.process_time()
+        for _ in range(rounds):
+            for payload in payloads:
+                parse(payload)
+        return (time.process_time() - before) / (rounds * len(payloads))
+
+    unfiltered = run(discord.Client())
+
+    client = discord.Client()
+    message_filter = gateway.MessageCreateFilter(client, accounts)
+    message_filter.install()
+    filtered = run(client)
+
+    print("{} payloads, {} rounds, {} registered accounts".format(len(payloads), rounds, len(accounts)))
+    print("Candidates: {} ({:.1f}%)".format(message_filter.passed // rounds, message_filter.passed / (message_filter.passed + message_filter.skipped) * 100))
+    print("Unfiltered: {:.2f} us/event".format(unfiltered * 1000 * 1000))
+    print("Filtered:   {:.2f} us/event ({:.1f}x)".format(filtered * 1000 * 1000, unfiltered / filtered if filtered else float("inf")))
+
+
+if __name__ == "__main__":
+    main()
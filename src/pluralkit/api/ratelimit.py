@@ -0,0 +1,170 @@
+import math
+import os
+import time
+from collections import OrderedDict, namedtuple
+from typing import Callable, Dict, Hashable, List, Optional
+
+from aiohttp import web
+
+from pluralkit.utils import hash_token
+
+
+class RateLimit(namedtuple("RateLimit", ["requests", "seconds"])):
+    """Allows bursts of up to `requests` requests, refilling at `requests` per `seconds`."""
+
+    @classmethod
+    def parse(cls, value: str) -> "RateLimit":
+        """
+        Parses a limit given as "<requests>/<seconds>", eg. "120/60".
+
+        :raises: ValueError if it's malformed, or allows less than one request or takes no time to refill
+        """
+        try:
+            requests, seconds = value.split("/")
+            limit = cls(int(requests), float(seconds))
+        except ValueError:
+            raise ValueError("Rate limit {!r} is not of the form <requests>/<seconds>".format(value))
+        if limit.requests < 1 or not 0 < limit.seconds < math.inf:
+            raise ValueError("Rate limit {!r} needs at least 1 request over more than 0 seconds".format(value))
+        return limit
+
+    @classmethod
+    def from_env(cls, name: str, default: str) -> "RateLimit":
+        """
+        Parses the limit in the given environment variable, or the default if it's unset.
+
+        :raises: ValueError naming the variable if it's invalid
+        """
+        try:
+            return cls.parse(os.environ.get(name) or default)
+        except ValueError as e:
+            raise ValueError("Invalid {}: {}".format(name, e)) from None
+
+    @property
+    def rate(self) -> float:
+        return self.requests / self.seconds
+
+
+RateLimitResult = namedtuple("RateLimitResult", ["allowed", "limit", "remaining", "reset_after", "retry_after"])
+
+
+class TokenBucket:
+    __slots__ = ["tokens", "last"]
+
+    def __init__(self, tokens: float, last: float):
+        self.tokens = tokens
+        self.last = last
+
+
+class RateLimiter:
+    """
+    Token buckets for any number of keys, all sharing one limit.
+
+    At most `max_keys` buckets are kept; the least recently used ones are dropped beyond that, which just
+    resets those keys to a full bucket.
+    """
+
+    def __init__(self, limit: RateLimit, max_keys: int = 10000):
+        self.limit = limit
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+
+    def take(self, key: Hashable, cost: float = 1, dry_run: bool = False) -> RateLimitResult:
+        """Takes `cost` tokens out of the key's bucket if there are enough. With `dry_run`, only checks if there are."""
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.limit.requests, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket.tokens = min(self.limit.requests, bucket.tokens + (now - bucket.last) * self.limit.rate)
+            bucket.last = now
+
+        allowed = bucket.tokens >= cost
+        if allowed and not dry_run:
+            bucket.tokens -= cost
+
+        return RateLimitResult(
+            allowed=allowed,
+            limit=self.limit.requests,
+            remaining=int(bucket.tokens),
+            reset_after=(self.limit.requests - bucket.tokens) / self.limit.rate,
+            retry_after=0 if allowed else (cost - bucket.tokens) / self.limit.rate
+        )
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+def client_token(request: web.Request) -> Optional[str]:
+    return request.headers.get("X-Token") or request.query.get("token")
+
+
+def client_ip(request: web.Request, forwarded_header: Optional[str] = None) -> str:
+    """
+    Returns the IP the request came from. Behind a reverse proxy, that's read from the header it's configured to set
+    (eg. X-Real-IP or X-Forwarded-For, where the last address is the one the proxy itself added).
+    """
+    if forwarded_header:
+        forwarded = request.headers.get(forwarded_header, "").split(",")[-1].strip()
+        if forwarded:
+            return forwarded
+    return request.remote
+
+
+def client_keys(request: web.Request, forwarded_header: Optional[str] = None) -> List[Hashable]:
+    """Returns the keys a client's requests are limited by: its IP, and its API token (hashed) if it gave one."""
+    # The IP limit always applies, so a client can't dodge it by making up tokens
+    keys = [("ip", client_ip(request, forwarded_header))]
+
+    token = client_token(request)
+    if token:
+        # Keyed by hash so the limiter doesn't keep raw tokens around
+        keys.append(("token", hash_token(token)))
+    return keys
+
+
+def rate_limit_middleware(limits: Dict[str, RateLimit], classify: Callable[[web.Request], str], max_keys: int = 10000,
+                          forwarded_header: Optional[str] = None):
+    """
+    Builds a middleware limiting requests per client IP, and additionally per API token where one is given. Requests
+    only count against the limits once they're allowed by all of them, so denied requests don't use anything up.
+
+    `classify` maps a request to a route class, which picks its limit out of `limits` (unlisted classes aren't
+    limited). Every route class has its own buckets. The outcome is stored on the request for `add_rate_limit_headers`.
+    `forwarded_header` is the header a trusted reverse proxy puts the client IP in, see `client_ip`.
+    """
+    limiters = {route_class: RateLimiter(limit, max_keys) for route_class, limit in limits.items()}
+
+    @web.middleware
+    async def rate_limit(request: web.Request, handler):
+        limiter = limiters.get(classify(request))
+        if not limiter:
+            return await handler(request)
+
+        keys = client_keys(request, forwarded_header)
+        results = [limiter.take(key, dry_run=True) for key in keys]
+        if all(result.allowed for result in results):
+            results = [limiter.take(key) for key in keys]
+
+        denied = [result for result in results if not result.allowed]
+        result = max(denied, key=lambda r: r.retry_after) if denied else min(results, key=lambda r: r.remaining)
+        request["rate_limit"] = result
+
+        if not result.allowed:
+            raise web.HTTPTooManyRequests(headers={"Retry-After": str(math.ceil(result.retry_after))},
+                                          text="Rate limit exceeded")
+        return await handler(request)
+
+    return rate_limit
+
+
+async def add_rate_limit_headers(request: web.Request, response: web.StreamResponse):
+    # Hooked into on_response_prepare, so this also covers error responses and streamed responses
+    result = request.get("rate_limit")
+    if result:
+        response.headers["X-RateLimit-Limit"] = str(result.limit)
+        response.headers["X-RateLimit-Remaining"] = str(result.remaining)
+        response.headers["X-RateLimit-Reset"] = str(math.ceil(result.reset_after))
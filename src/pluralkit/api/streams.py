@@ -0,0 +1,110 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Hashable, Optional, Sequence, Set
+
+logger = logging.getLogger("pluralkit.api.streams")
+
+
+class Subscriber:
+    __slots__ = ["queue", "overflowed", "client_keys"]
+
+    def __init__(self, queue_size: int, client_keys: Sequence[Hashable]):
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.overflowed = False
+        self.client_keys = client_keys
+
+
+class SystemStreamHub:
+    """
+    Fans out events about a system to every stream subscribed to it.
+
+    Events are rendered by `render(system_id, event_type)` once per event, not once per subscriber, in order, by a
+    single worker (see `run`). Subscribers that fall more than `queue_size` events behind are cut off rather than
+    buffered for - clients are expected to reconnect and start over from the current state.
+
+    Streams are limited in total, per system, and per client. Clients are identified by any number of keys (eg. their
+    IP and API token), each of which can only have `max_streams_per_client` streams open.
+    """
+
+    def __init__(self, render: Callable[[int, str], Awaitable[bytes]], max_streams: int = 1000,
+                 max_streams_per_system: int = 10, max_streams_per_client: int = 5, queue_size: int = 16):
+        self.render = render
+        self.max_streams = max_streams
+        self.max_streams_per_system = max_streams_per_system
+        self.max_streams_per_client = max_streams_per_client
+        self.queue_size = queue_size
+
+        self.subscribers: Dict[int, Set[Subscriber]] = {}
+        self.client_stream_counts: Dict[Hashable, int] = {}
+        self.stream_count = 0
+        self._pending = asyncio.Queue()
+
+    def client_at_limit(self, client_keys: Sequence[Hashable]) -> bool:
+        return any(self.client_stream_counts.get(key, 0) >= self.max_streams_per_client for key in client_keys)
+
+    def subscribe(self, system_id: int, client_keys: Sequence[Hashable] = ()) -> Optional[Subscriber]:
+        """
+        Returns a new subscriber to the given system's events, or None if that would exceed the stream limits
+        (see `client_at_limit` to tell whether it's the client's own limit).
+        """
+        subscribers = self.subscribers.get(system_id, ())
+        if self.stream_count >= self.max_streams or len(subscribers) >= self.max_streams_per_system \
+                or self.client_at_limit(client_keys):
+            return None
+
+        subscriber = Subscriber(self.queue_size, client_keys)
+        self.subscribers.setdefault(system_id, set()).add(subscriber)
+        self.stream_count += 1
+        for key in client_keys:
+            self.client_stream_counts[key] = self.client_stream_counts.get(key, 0) + 1
+        return subscriber
+
+    def unsubscribe(self, system_id: int, subscriber: Subscriber):
+        subscribers = self.subscribers.get(system_id)
+        if subscribers and subscriber in subscribers:
+            subscribers.remove(subscriber)
+            self.stream_count -= 1
+            if not subscribers:
+                del self.subscribers[system_id]
+
+            for key in subscriber.client_keys:
+                self.client_stream_counts[key] -= 1
+                if not self.client_stream_counts[key]:
+                    del self.client_stream_counts[key]
+
+    def notify(self, system_id: Optional[int], event_type: str):
+        """Queues an event for rendering and delivery. A system ID of None means all systems with subscribers."""
+        if system_id is None:
+            for subscribed_id in list(self.subscribers.keys()):
+                self._pending.put_nowait((subscribed_id, event_type))
+        elif system_id in self.subscribers:
+            self._pending.put_nowait((system_id, event_type))
+
+    def publish(self, system_id: int, data: bytes):
+        for subscriber in self.subscribers.get(system_id, ()):
+            if subscriber.overflowed:
+                continue
+
+            if subscriber.queue.full():
+                # Swap the backlog for the end-of-stream marker, so the stream closes as soon as it next looks
+                subscriber.overflowed = True
+                while not subscriber.queue.empty():
+                    subscriber.queue.get_nowait()
+                subscriber.queue.put_nowait(None)
+            else:
+                subscriber.queue.put_nowait(data)
+
+    async def run(self):
+        while True:
+            system_id, event_type = await self._pending.get()
+
+            # Everyone may have disconnected in the meantime
+            if system_id not in self.subscribers:
+                continue
+
+            try:
+                data = await self.render(system_id, event_type)
+            except Exception:
+                logger.exception("Error rendering {} event for system {}".format(event_type, system_id))
+                continue
+            self.publish(system_id, data)
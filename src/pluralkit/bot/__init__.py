@@ -6,14 +6,16 @@ import discord
 import logging
 import os
 import traceback
+from typing import List
 
-from pluralkit import db
-from pluralkit.bot import commands, proxy, channel_logger, embeds
+from pluralkit import db, stats
+from pluralkit.bot import commands, proxy, channel_logger, embeds, gateway
+from pluralkit.utils import workers
 
 logging.basicConfig(level=logging.INFO, format="[%(asctime)s] [%(name)s] [%(levelname)s] %(message)s")
 
 
-def connect_to_database() -> asyncpg.pool.Pool:
+def get_database_credentials() -> dict:
     username = os.environ["DATABASE_USER"]
     password = os.environ["DATABASE_PASS"]
     name = os.environ["DATABASE_NAME"]
@@ -32,13 +34,84 @@ def connect_to_database() -> asyncpg.pool.Pool:
         print("Please pass a valid integer as the DATABASE_PORT environment variable.", file=sys.stderr)
         sys.exit(1)
 
-    return asyncio.get_event_loop().run_until_complete(db.connect(
-        username=username,
-        password=password,
-        database=name,
-        host=host,
-        port=port
-    ))
+    return {
+        "username": username,
+        "password": password,
+        "database": name,
+        "host": host,
+        "port": port
+    }
+
+
+def parse_shard_ids(value: str) -> List[int]:
+    """Parses a list of shard IDs and ranges of them, eg. "0,1,4-7"."""
+    shard_ids = []
+    for part in value.split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            shard_ids.extend(range(int(first), int(last) + 1))
+        elif part.strip():
+            shard_ids.append(int(part))
+    return shard_ids
+
+
+def client_options() -> dict:
+    # PluralKit works off IDs almost everywhere (looking up channels with get_channel and users over HTTP),
+    # so with LEAN_CLIENT set, the client doesn't keep offline guild members and only a minimal message backlog
+    if not os.environ.get("LEAN_CLIENT"):
+        return {}
+    return {"max_messages": 100, "fetch_offline_members": False}
+
+
+def lean_client_state(client: discord.Client):
+    # Presence updates make up most gateway traffic in big guilds, and are only used to keep cached members' status
+    # and activity up to date, which nothing here looks at
+    gateway.replace_parser(client, "PRESENCE_UPDATE", lambda data: None)
+
+
+def memory_usage() -> int:
+    """
+    Returns the process' resident set size in bytes (or the peak of it, where the current one isn't available).
+    Returns 0 where neither is, ie. on Windows.
+    """
+    try:
+        # Unix only, like uvloop
+        import resource
+    except ImportError:
+        return 0
+
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def create_client() -> discord.Client:
+    # SHARD_COUNT is either a number of shards or "auto" (to use what Discord recommends), and SHARD_IDS
+    # which of those to run in this process (all of them by default). See shard_main.py for running several processes
+    shard_count = os.environ.get("SHARD_COUNT")
+    shard_ids = os.environ.get("SHARD_IDS")
+    options = client_options()
+    if not shard_count:
+        return discord.Client(**options)
+
+    if shard_count == "auto":
+        if shard_ids:
+            print("SHARD_IDS requires an explicit SHARD_COUNT.", file=sys.stderr)
+            sys.exit(1)
+        return discord.AutoShardedClient(**options)
+
+    try:
+        return discord.AutoShardedClient(shard_count=int(shard_count),
+                                         shard_ids=parse_shard_ids(shard_ids) if shard_ids else None, **options)
+    except ValueError:
+        print("Please pass a valid integer as SHARD_COUNT, and a list of shard IDs (eg. 0-3,8) as SHARD_IDS.", file=sys.stderr)
+        sys.exit(1)
+
+
+def connect_to_database() -> asyncpg.pool.Pool:
+    return asyncio.get_event_loop().run_until_complete(db.connect(**get_database_credentials()))
 
 
 def run():
@@ -50,18 +123,125 @@ def run():
 
     asyncio.get_event_loop().run_until_complete(create_tables())
 
-    client = discord.Client()
+    # Lets in-process caches hear about writes made by other processes (the API, other shards)
+    asyncio.get_event_loop().create_task(db.listen_for_invalidations(**get_database_credentials()))
+
+    async def message_retention_loop():
+        # Keeps message partitions ahead of time and archives ones past the retention horizon (if configured)
+        archive_dir = os.environ.get("MESSAGE_ARCHIVE_DIR") or "message_archive"
+        while True:
+            await asyncio.sleep(6 * 60 * 60)
+            try:
+                async with pool.acquire() as conn:
+                    await db.run_message_retention(conn, archive_dir)
+            except Exception:
+                logging.getLogger("pluralkit").exception("Error while running message retention")
+
+    asyncio.get_event_loop().create_task(message_retention_loop())
+
+    async def backfill_front_rollup():
+        # Only does anything the first time around, or for systems whose rollup went missing
+        try:
+            async with pool.acquire() as conn:
+                await db.backfill_front_rollup(conn)
+        except Exception:
+            logging.getLogger("pluralkit").exception("Error while backfilling front time rollup")
+
+    asyncio.get_event_loop().create_task(backfill_front_rollup())
+
+    async def hid_pool_loop():
+        # Creating systems and members takes HIDs out of the pool, this puts new ones in before it runs dry
+        while True:
+            await asyncio.sleep(10 * 60)
+            try:
+                async with pool.acquire() as conn:
+                    await db.refill_hid_pool(conn)
+            except Exception:
+                logging.getLogger("pluralkit").exception("Error while refilling HID pool")
+
+    asyncio.get_event_loop().create_task(hid_pool_loop())
+
+    stats_cache = stats.StatsCache(pool, interval=10 * 60)
+    asyncio.get_event_loop().create_task(stats_cache.run())
+
+    client = create_client()
+    if os.environ.get("LEAN_CLIENT"):
+        lean_client_state(client)
+
+    # Opt-in fast path dropping messages that can't be commands or proxy candidates straight from the raw payload
+    message_filter = None
+    if os.environ.get("RAW_MESSAGE_FILTER"):
+        accounts = gateway.RegisteredAccounts(pool)
+        asyncio.get_event_loop().run_until_complete(accounts.reload())
+        db.register_invalidator("account", accounts.invalidate)
+        asyncio.get_event_loop().create_task(accounts.run())
+
+        message_filter = gateway.MessageCreateFilter(client, accounts)
+        message_filter.install()
+
+    if os.environ.get("MESSAGE_PAYLOAD_RECORD_FILE"):
+        gateway.PayloadRecorder(client, os.environ["MESSAGE_PAYLOAD_RECORD_FILE"]).install()
 
     logger = channel_logger.ChannelLogger(client)
 
+    async def presence_loop():
+        while True:
+            if stats_cache.generated_at:
+                presence = "pk;help | {} systems, {} members".format(stats_cache.systems, stats_cache.members)
+            else:
+                presence = "pk;help"
+
+            try:
+                await client.change_presence(activity=discord.Game(name=presence))
+            except Exception:
+                logging.getLogger("pluralkit").exception("Error while updating presence")
+            await asyncio.sleep(stats_cache.interval)
+
+    async def heartbeat_loop(path: str):
+        # Lets the shard supervisor notice a worker that's stuck or can't connect (see shard_main.py)
+        while True:
+            if client.is_ready() and not client.is_closed():
+                with open(path, "a"):
+                    os.utime(path, None)
+            await asyncio.sleep(15)
+
+    heartbeat_file = os.environ.get("SHARD_HEARTBEAT_FILE")
+    if heartbeat_file:
+        asyncio.get_event_loop().create_task(heartbeat_loop(heartbeat_file))
+
+    async def memory_report_loop():
+        # For comparing memory use with and without LEAN_CLIENT
+        while True:
+            rss = memory_usage()
+            guilds = len(client.guilds)
+            logging.getLogger("pluralkit").info(
+                "RSS {:.1f} MiB, {} guilds ({:.1f} KiB per guild), {} cached users, {} cached messages (lean client {})".format(
+                    rss / 1024 / 1024, guilds, rss / 1024 / guilds if guilds else 0, len(client.users),
+                    len(client._connection._messages), "on" if os.environ.get("LEAN_CLIENT") else "off"))
+
+            if message_filter:
+                total = message_filter.passed + message_filter.skipped
+                logging.getLogger("pluralkit").info("Message filter skipped {} of {} messages ({:.1f}%), {} registered accounts".format(
+                    message_filter.skipped, total, message_filter.skipped / total * 100 if total else 0,
+                    len(message_filter.accounts)))
+
+            logging.getLogger("pluralkit").info("Worker tasks: {}".format(workers.report()))
+            await asyncio.sleep(10 * 60)
+
+    presence_task = None
+
     @client.event
     async def on_ready():
+        nonlocal presence_task
         print("PluralKit started.")
         print("User: {}#{} (ID: {})".format(client.user.name, client.user.discriminator, client.user.id))
         print("{} servers".format(len(client.guilds)))
         print("{} shards".format(client.shard_count or 1))
 
-        await client.change_presence(activity=discord.Game(name="pk;help"))
+        # on_ready fires again after reconnects, only start the loop once
+        if not presence_task:
+            presence_task = client.loop.create_task(presence_loop())
+            client.loop.create_task(memory_report_loop())
 
     @client.event
     async def on_message(message: discord.Message):
@@ -72,7 +252,7 @@ def run():
         # Grab a database connection from the pool
         async with pool.acquire() as conn:
             # First pass: do command handling
-            did_run_command = await commands.command_dispatch(client, message, conn)
+            did_run_command = await commands.command_dispatch(client, message, conn, pool)
             if did_run_command:
                 return
 
@@ -1,9 +1,10 @@
 import asyncio
+import logging
 from datetime import datetime
 
 import discord
 import re
-from typing import Tuple, Optional, Union
+from typing import Any, Awaitable, Callable, Tuple, Optional, Union
 
 from pluralkit import db
 from pluralkit.bot import embeds, utils
@@ -42,10 +43,11 @@ class CommandError(Exception):
 
 
 class CommandContext:
-    def __init__(self, client: discord.Client, message: discord.Message, conn, args: str, system: Optional[System]):
+    def __init__(self, client: discord.Client, message: discord.Message, conn, args: str, system: Optional[System], pool=None):
         self.client = client
         self.message = message
         self.conn = conn
+        self.pool = pool
         self.args = args
         self._system = system
 
@@ -109,7 +111,12 @@ class CommandContext:
 
         member = await utils.get_member_fuzzy(self.conn, system.id if system else None, name, system_only)
         if not member:
-            raise CommandError("Unable to find member '{}'{}.".format(name, " in your system" if system_only else ""))
+            suggestions = await Member.search(self.conn, system.id, name, limit=3) if system else []
+            did_you_mean = ""
+            if suggestions:
+                did_you_mean = " Did you mean {}?".format(" or ".join(
+                    "**{}** (`{}`)".format(utils.escape(suggestion.name), suggestion.hid) for suggestion, _ in suggestions))
+            raise CommandError("Unable to find member '{}'{}.{}".format(name, " in your system" if system_only else "", did_you_mean))
 
         return member
 
@@ -136,15 +143,69 @@ class CommandContext:
         await message.add_reaction("\u2705")  # Checkmark
         await message.add_reaction("\u274c")  # Red X
 
+        # Raw event, since the message may well have dropped out of the (small) message cache by the time anyone reacts
+        def check(payload: discord.RawReactionActionEvent):
+            return payload.message_id == message.id and payload.user_id == user.id and payload.emoji.name in ["\u2705", "\u274c"]
+
         try:
-            reaction, _ = await self.client.wait_for("reaction_add",
-                                                     check=lambda r, u: u.id == user.id and r.emoji in ["\u2705",
-                                                                                                        "\u274c"],
-                                                     timeout=60.0 * 5)
-            return reaction.emoji == "\u2705"
+            payload = await self.client.wait_for("raw_reaction_add", check=check, timeout=60.0 * 5)
+            return payload.emoji.name == "\u2705"
         except asyncio.TimeoutError:
             raise CommandError("Timed out - try again.")
 
+    async def paginate(self, page_count: int, render_page: Callable[[Any, int], Awaitable[discord.Embed]]):
+        """
+        Replies with the first page, and lets the command's author flip through the rest with reactions.
+
+        Pages are only rendered once they're flipped to, by `render_page(conn, page)`, so a page can be a query of its
+        own. Flipping happens in the background after the command returns, on a connection taken from the pool for
+        each page, so the command's own connection isn't held on to while waiting for reactions.
+        """
+        message = await self.reply(embed=await render_page(self.conn, 0))
+        if page_count > 1:
+            self.client.loop.create_task(self.flip_pages(message, page_count, render_page))
+
+    async def flip_pages(self, message: discord.Message, page_count: int, render_page: Callable[[Any, int], Awaitable[discord.Embed]]):
+        # Runs as its own task, which nothing awaits, so errors (eg. no permission to add reactions) get logged here
+        try:
+            page = 0
+            await message.add_reaction("\u2b05")  # Left arrow
+            await message.add_reaction("\u27a1")  # Right arrow
+
+            def check(payload: discord.RawReactionActionEvent):
+                return payload.message_id == message.id and payload.user_id == self.message.author.id and payload.emoji.name in ["\u2b05", "\u27a1"]
+
+            # If the bot can't take the user's reaction back off again (in DMs, or without permission), removing it counts too
+            can_remove = isinstance(self.message.channel, discord.TextChannel) and \
+                self.message.channel.permissions_for(self.message.guild.me).manage_messages
+            events = ["raw_reaction_add"] if can_remove else ["raw_reaction_add", "raw_reaction_remove"]
+
+            while True:
+                waits = [asyncio.ensure_future(self.client.wait_for(event, check=check)) for event in events]
+                done, pending = await asyncio.wait(waits, timeout=60.0 * 5, return_when=asyncio.FIRST_COMPLETED)
+                for wait in pending:
+                    wait.cancel()
+                if not done:
+                    break
+
+                payload = done.pop().result()
+                page = (page + (1 if payload.emoji.name == "\u27a1" else -1)) % page_count
+                async with self.pool.acquire() as conn:
+                    embed = await render_page(conn, page)
+                try:
+                    await message.edit(embed=embed)
+                except discord.NotFound:
+                    # The message was deleted, nothing left to flip through
+                    break
+
+                if can_remove:
+                    try:
+                        await message.remove_reaction(payload.emoji, self.message.author)
+                    except discord.HTTPException:
+                        pass
+        except Exception:
+            logging.getLogger("pluralkit").exception("Error while paginating message {}".format(message.id))
+
     async def confirm_text(self, user: discord.Member, channel: discord.TextChannel, confirm_text: str, message: str):
         await self.reply(message)
 
@@ -210,7 +271,7 @@ async def run_command(ctx: CommandContext, func):
         await ctx.reply(content=content, embed=embed)
 
 
-async def command_dispatch(client: discord.Client, message: discord.Message, conn) -> bool:
+async def command_dispatch(client: discord.Client, message: discord.Message, conn, pool) -> bool:
     prefix = "^(pk(;|!)|<@{}> )".format(client.user.id)
     regex = re.compile(prefix, re.IGNORECASE)
 
@@ -223,7 +284,8 @@ async def command_dispatch(client: discord.Client, message: discord.Message, con
             message=message,
             conn=conn,
             args=remaining_string,
-            system=await System.get_by_account(conn, message.author.id)
+            system=await System.get_by_account(conn, message.author.id),
+            pool=pool
         )
         await run_command(ctx, command_root)
         return True
@@ -1,4 +1,4 @@
-from pluralkit.bot.commands import CommandContext
+from pluralkit.bot.commands import CommandContext, CommandError
 
 disclaimer = "Please note that this grants access to modify (and delete!) all your system data, so keep it safe and secure. If it leaks or you need a new one, you can invalidate this one with `pk;token refresh`."
 
@@ -13,11 +13,11 @@ async def token_root(ctx: CommandContext):
 async def token_get(ctx: CommandContext):
     system = await ctx.ensure_system()
 
-    if system.token:
-        token = system.token
-    else:
-        token = await system.refresh_token(ctx.conn)
+    if system.token_hash:
+        # Only the hash is stored, so there's no way to show an existing token again
+        raise CommandError("You already have an API token. Tokens are stored securely and can't be shown again, so if you've lost yours, use `pk;token refresh` to get a new one (this invalidates the old one).")
 
+    token = await system.refresh_token(ctx.conn)
     token_message = "Here's your API token: \n**`{}`**\n{}".format(token, disclaimer)
     return await ctx.reply_ok_dm(token_message)
 
@@ -6,6 +6,7 @@ import os
 from datetime import datetime
 
 from pluralkit.errors import TupperboxImportError
+from pluralkit.utils import workers
 from pluralkit.bot.commands import *
 
 async def import_root(ctx: CommandContext):
@@ -31,7 +32,8 @@ async def import_tupperbox(ctx: CommandContext):
 
     s = io.BytesIO()
     await message.attachments[0].save(s)
-    data = json.load(s)
+    # Parsed on a thread rather than a worker process, since the result would have to be pickled back anyway
+    data = await workers.run(json.loads, s.getvalue())
     
     system = await ctx.get_system()
     if not system:
@@ -11,13 +11,24 @@ async def member_root(ctx: CommandContext):
         await ctx.reply(help.member_commands)
     elif ctx.match("set"):
         await member_set(ctx)
-    # TODO "pk;member list"
+    elif await is_list_command(ctx):
+        ctx.pop_str()
+        await pluralkit.bot.commands.system_commands.system_list(ctx, await ctx.ensure_system())
     elif not ctx.has_next():
         raise CommandError("Must pass a subcommand. For a list of subcommands, type `pk;help member`.")
     else:
         await specific_member_root(ctx)
 
 
+async def is_list_command(ctx: CommandContext) -> bool:
+    # Members named "list" predate the command, so they still come first (`pk;system list` works for them either way)
+    if (ctx.peek_str() or "").lower() != "list":
+        return False
+
+    system = await ctx.get_system()
+    return not system or not await utils.get_member_fuzzy(ctx.conn, system.id, ctx.peek_str())
+
+
 async def specific_member_root(ctx: CommandContext):
     member = await ctx.pop_member(system_only=False)
 
@@ -6,6 +6,7 @@ from discord.utils import oauth_url
 from pluralkit.bot import help
 from pluralkit.bot.commands import *
 from pluralkit.bot.embeds import help_footer_embed
+from pluralkit.utils import workers
 
 
 async def help_root(ctx: CommandContext):
@@ -58,7 +59,8 @@ async def export(ctx: CommandContext):
 
     members = await system.get_members(ctx.conn)
     accounts = await system.get_linked_account_ids(ctx.conn)
-    switches = await system.get_switches(ctx.conn, 999999)
+    switches = await system.get_switches_with_members(ctx.conn, 999999)
+    message_counts = await db.get_member_message_counts(ctx.conn, [member.id for member in members])
 
     data = {
         "name": system.name,
@@ -79,21 +81,21 @@ async def export(ctx: CommandContext):
                 "prefix": member.prefix,
                 "suffix": member.suffix,
                 "created": member.created.isoformat(),
-                "message_count": await member.message_count(ctx.conn)
+                "message_count": message_counts.get(member.id, 0)
             } for member in members
         ],
         "accounts": [str(uid) for uid in accounts],
         "switches": [
             {
                 "timestamp": switch.timestamp.isoformat(),
-                "members": [member.hid for member in await switch.fetch_members(ctx.conn)]
-            } for switch in switches
+                "members": [member.hid for member in switch_members]
+            } for switch, switch_members in switches
         ]  # TODO: messages
     }
 
     await working_msg.delete()
 
-    f = io.BytesIO(json.dumps(data).encode("utf-8"))
+    f = io.BytesIO((await workers.run(json.dumps, data)).encode("utf-8"))
     await ctx.message.author.send(content="Here you go!", file=discord.File(fp=f, filename="pluralkit_system.json"))
 
 
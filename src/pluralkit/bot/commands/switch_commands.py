@@ -6,7 +6,7 @@ import pytz
 
 from pluralkit.bot.commands import *
 from pluralkit.member import Member
-from pluralkit.utils import display_relative
+from pluralkit.utils import display_relative, workers
 
 
 async def switch_root(ctx: CommandContext):
@@ -58,18 +58,18 @@ async def switch_out(ctx: CommandContext):
 async def switch_delete(ctx: CommandContext):
     system = await ctx.ensure_system()
 
-    last_two_switches = await system.get_switches(ctx.conn, 2)
+    last_two_switches = await system.get_switches_with_members(ctx.conn, 2)
     if not last_two_switches:
         raise CommandError("You do not have a logged switch to delete.")
 
-    last_switch = last_two_switches[0]
-    next_last_switch = last_two_switches[1] if len(last_two_switches) > 1 else None
+    last_switch, last_switch_fronters = last_two_switches[0]
+    next_last_switch, next_last_switch_fronters = last_two_switches[1] if len(last_two_switches) > 1 else (None, None)
 
-    last_switch_members = ", ".join([member.name for member in await last_switch.fetch_members(ctx.conn)])
+    last_switch_members = ", ".join([member.name for member in last_switch_fronters])
     last_switch_time = display_relative(last_switch.timestamp)
 
     if next_last_switch:
-        next_last_switch_members = ", ".join([member.name for member in await next_last_switch.fetch_members(ctx.conn)])
+        next_last_switch_members = ", ".join([member.name for member in next_last_switch_fronters])
         next_last_switch_time = display_relative(next_last_switch.timestamp)
         msg = await ctx.reply_warn("This will delete the latest switch ({}, {} ago). The next latest switch is {} ({} ago). Is this okay?".format(last_switch_members, last_switch_time, next_last_switch_members, next_last_switch_time))
     else:
@@ -94,7 +94,7 @@ async def switch_move(ctx: CommandContext):
         raise CommandError("You must pass a time to move the switch to.")
 
     # Parse the time to move to
-    new_time = dateparser.parse(ctx.remaining(), languages=["en"], settings={
+    new_time = await workers.run(dateparser.parse, ctx.remaining(), cpu_bound=True, languages=["en"], settings={
         # Tell it to default to the system's given time zone
         # If no time zone was given *explicitly in the string* it'll return as naive
         "TIMEZONE": system.ui_tz
@@ -118,13 +118,13 @@ async def switch_move(ctx: CommandContext):
     # Make sure it all runs in a big transaction for atomicity
     async with ctx.conn.transaction():
         # Get the last two switches to make sure the switch to move isn't before the second-last switch
-        last_two_switches = await system.get_switches(ctx.conn, 2)
+        last_two_switches = await system.get_switches_with_members(ctx.conn, 2)
         if len(last_two_switches) == 0:
             raise CommandError("There are no registered switches for this system.")
 
-        last_switch = last_two_switches[0]
+        last_switch, last_fronters = last_two_switches[0]
         if len(last_two_switches) > 1:
-            second_last_switch = last_two_switches[1]
+            second_last_switch, _ = last_two_switches[1]
 
             if new_time < second_last_switch.timestamp:
                 time_str = display_relative(second_last_switch.timestamp)
@@ -132,8 +132,6 @@ async def switch_move(ctx: CommandContext):
                     "Can't move switch to before last switch time ({} ago), as it would cause conflicts.".format(time_str))
 
         # Display the confirmation message w/ humanized times
-        last_fronters = await last_switch.fetch_members(ctx.conn)
-
         members = ", ".join([member.name for member in last_fronters]) or "nobody"
         last_absolute = ctx.format_time(last_switch.timestamp)
         last_relative = display_relative(last_switch.timestamp)
@@ -3,17 +3,13 @@ from datetime import datetime, timedelta
 import aiohttp
 import dateparser
 import humanize
-import timezonefinder
 import pytz
 
 import pluralkit.bot.embeds
 from pluralkit.bot.commands import *
+from pluralkit import gazetteer
 from pluralkit.errors import ExistingSystemError, UnlinkingLastAccountError, AccountAlreadyLinkedError
-from pluralkit.utils import display_relative
-
-# This needs to load from the timezone file so we're preloading this so we
-# don't have to do it on every invocation
-tzf = timezonefinder.TimezoneFinder()
+from pluralkit.utils import display_relative, workers
 
 async def system_root(ctx: CommandContext):
     # Commands that operate without a specified system (usually defaults to the executor's own system)
@@ -37,6 +33,8 @@ async def system_root(ctx: CommandContext):
         await system_frontpercent(ctx, await ctx.ensure_system())
     elif ctx.match("timezone") or ctx.match("tz"):
         await system_timezone(ctx)
+    elif ctx.match("list") or ctx.match("members"):
+        await system_list(ctx, await ctx.ensure_system())
     elif ctx.match("set"):
         await system_set(ctx)
     elif not ctx.has_next():
@@ -63,6 +61,8 @@ async def specified_system_root(ctx: CommandContext):
         await system_fronthistory(ctx, system)
     elif ctx.match("frontpercent") or ctx.match("frontbreakdown") or ctx.match("frontpercentage"):
         await system_frontpercent(ctx, system)
+    elif ctx.match("list") or ctx.match("members"):
+        await system_list(ctx, system)
     else:
         await system_info(ctx, system)
 
@@ -71,6 +71,18 @@ async def system_info(ctx: CommandContext, system: System):
     await ctx.reply(embed=await pluralkit.bot.embeds.system_card(ctx.conn, ctx.client, system))
 
 
+async def system_list(ctx: CommandContext, system: System):
+    page_size = pluralkit.bot.embeds.MEMBER_LIST_PAGE_SIZE
+    member_count = await system.get_member_count(ctx.conn)
+    page_count = max(1, -(-member_count // page_size))
+
+    async def render_page(conn, page: int):
+        members = await system.get_members_page(conn, page_size, page * page_size)
+        return pluralkit.bot.embeds.member_list_page(system, members, page, page_count, member_count)
+
+    await ctx.paginate(page_count, render_page)
+
+
 async def system_new(ctx: CommandContext):
     new_name = ctx.remaining() or None
 
@@ -107,32 +119,28 @@ async def system_timezone(ctx: CommandContext):
     system = await ctx.ensure_system()
     city_query = ctx.remaining() or None
 
-    msg = await ctx.reply("\U0001F50D Searching '{}' (may take a while)...".format(city_query))
-
-    # Look up the city on Overpass (OpenStreetMap)
-    async with aiohttp.ClientSession() as sess:
-        # OverpassQL is weird, but this basically searches for every node of type city with name [input].
-        async with sess.get("https://nominatim.openstreetmap.org/search?city=novosibirsk&format=json&limit=1", params={"city": city_query, "format": "json", "limit": "1"}) as r:
-            if r.status != 200:
-                raise CommandError("OSM Nominatim API returned error. Try again.")
-            data = await r.json()
+    # Look up the city in the local gazetteer first, and only go out to OSM Nominatim if it isn't there
+    local = gazetteer.get_gazetteer()
+    city = local.find(city_query) if local else None
+    source = "GeoNames"
+    if not city:
+        await ctx.reply("\U0001F50D Searching '{}' (may take a while)...".format(city_query))
+        try:
+            city = await gazetteer.find_city_nominatim(city_query)
+        except aiohttp.ClientError:
+            raise CommandError("OSM Nominatim API returned error. Try again.")
+        source = "OpenStreetMap, queried using Nominatim"
 
     # If we didn't find a city, complain
-    if not data:
+    if not city:
         raise CommandError("City '{}' not found.".format(city_query))
 
-    # Take the lat/long given by Overpass and put it into timezonefinder
-    lat, lng = (float(data[0]["lat"]), float(data[0]["lon"]))
-    timezone_name = tzf.timezone_at(lng=lng, lat=lat)
-    if not timezone_name:
-        raise CommandError("Time zone for city '{}' not found. This should never happen.".format(data[0]["display_name"]))
-    
     # This should hopefully result in a valid time zone name
     # (if not, something went wrong)
-    tz = await system.set_time_zone(ctx.conn, timezone_name)
+    tz = await system.set_time_zone(ctx.conn, city.timezone)
     offset = tz.utcoffset(datetime.utcnow())
     offset_str = "UTC{:+02d}:{:02d}".format(int(offset.total_seconds() // 3600), int(offset.total_seconds() // 60 % 60))
-    await ctx.reply_ok("System time zone set to {} ({}, {}).\n*Data from OpenStreetMap, queried using Nominatim.*".format(tz.tzname(datetime.utcnow()), offset_str, tz.zone))
+    await ctx.reply_ok("System time zone set to {} ({}, {}, for {}).\n*Data from {}.*".format(tz.tzname(datetime.utcnow()), offset_str, tz.zone, city.display_name, source))
 
 
 async def system_tag(ctx: CommandContext):
@@ -221,7 +229,9 @@ async def account_unlink(ctx: CommandContext):
 
 
 async def system_fronter(ctx: CommandContext, system: System):
-    embed = await embeds.front_status(ctx, await system.get_latest_switch(ctx.conn))
+    current = await db.get_current_switch_with_members(ctx.conn, system.id)
+    switch, fronters = current if current else (None, [])
+    embed = await embeds.front_status(ctx, switch, fronters)
     await ctx.reply(embed=embed)
 
 
@@ -269,7 +279,7 @@ async def system_delete(ctx: CommandContext):
 async def system_frontpercent(ctx: CommandContext, system: System):
     # Parse the time limit (will go this far back)
     if ctx.remaining():
-        before = dateparser.parse(ctx.remaining(), languages=["en"], settings={
+        before = await workers.run(dateparser.parse, ctx.remaining(), cpu_bound=True, languages=["en"], settings={
             "TO_TIMEZONE": "UTC",
             "RETURN_AS_TIMEZONE_AWARE": False
         })
@@ -283,69 +293,18 @@ async def system_frontpercent(ctx: CommandContext, system: System):
     else:
         before = datetime.utcnow() - timedelta(days=30)
 
-    # Fetch list of switches
-    all_switches = await pluralkit.utils.get_front_history(ctx.conn, system.id, 99999)
-    if not all_switches:
+    breakdown = await pluralkit.utils.get_front_breakdown(ctx.conn, system.id, before)
+    if not breakdown:
         raise CommandError("No switches registered to this system.")
 
-    # Cull the switches *ending* before the limit, if given
-    # We'll need to find the first switch starting before the limit, then cut off every switch *before* that
-    if before:
-        for last_stamp, _ in all_switches:
-            if last_stamp < before:
-                break
-
-        all_switches = [(stamp, members) for stamp, members in all_switches if stamp >= last_stamp]
-
-    start_times = [stamp for stamp, _ in all_switches]
-    end_times = [datetime.utcnow()] + start_times
-    switch_members = [members for _, members in all_switches]
-
-    # Gonna save a list of members by ID for future lookup too
-    members_by_id = {}
-
-    # Using the ID as a key here because it's a simple number that can be hashed and used as a key
-    member_times = {}
-    for start_time, end_time, members in zip(start_times, end_times, switch_members):
-        # Cut off parts of the switch that occurs before the time limit (will only happen if this is the last switch)
-        if before and start_time < before:
-            start_time = before
-
-        # Calculate length of the switch
-        switch_length = end_time - start_time
-
-        def add_switch(id, length):
-            if id not in member_times:
-                member_times[id] = length
-            else:
-                member_times[id] += length
-
-        for member in members:
-            # Add the switch length to the currently registered time for that member
-            add_switch(member.id, switch_length)
-
-            # Also save the member in the ID map for future reference
-            members_by_id[member.id] = member
-
-        # Also register a no-fronter switch with the key None
-        if not members:
-            add_switch(None, switch_length)
-
-    # Find the total timespan of the range
-    span_start = max(start_times[-1], before) if before else start_times[-1]
-    total_time = datetime.utcnow() - span_start
-
     embed = embeds.status("")
-    for member_id, front_time in sorted(member_times.items(), key=lambda x: x[1], reverse=True):
-        member = members_by_id[member_id] if member_id else None
-
+    for member, front_time in breakdown.members:
         # Calculate percent
-        fraction = front_time / total_time
-        percent = round(fraction * 100)
+        percent = round(breakdown.fraction(front_time) * 100)
 
         embed.add_field(name=member.name if member else "(no fronter)",
                         value="{}% ({})".format(percent, humanize.naturaldelta(front_time)))
 
-    embed.set_footer(text="Since {} ({} ago)".format(ctx.format_time(span_start),
-                                                     display_relative(span_start)))
+    embed.set_footer(text="Since {} ({} ago)".format(ctx.format_time(breakdown.span_start),
+                                                     display_relative(breakdown.span_start)))
     await ctx.reply(embed=embed)
@@ -1,15 +1,21 @@
+import asyncio
+
 import discord
 import humanize
-from typing import Tuple
+from typing import List, Tuple
 
 from pluralkit import db
-from pluralkit.bot.utils import escape
+from pluralkit.bot.utils import escape, get_user_cached, get_users_cached
 from pluralkit.member import Member
 from pluralkit.switch import Switch
 from pluralkit.system import System
 from pluralkit.utils import get_fronters, display_relative
 
 
+# Members per page in member lists (and on the system card)
+MEMBER_LIST_PAGE_SIZE = 20
+
+
 def truncate_field_name(s: str) -> str:
     return s[:256]
 
@@ -66,6 +72,19 @@ def exception_log(message_content, author_name, author_discriminator, author_id,
     return embed
 
 
+def member_list_text(members: List[Member]) -> str:
+    return "\n".join("{} (`{}`)".format(escape(member.name), member.hid) for member in members)
+
+
+def member_list_page(system: System, members: List[Member], page: int, page_count: int, member_count: int) -> discord.Embed:
+    embed = discord.Embed()
+    embed.colour = discord.Colour.blue()
+    embed.title = truncate_title("Members of {} ({})".format(system.name or "`{}`".format(system.hid), member_count))
+    embed.description = truncate_description(member_list_text(members) or "(no members)")
+    embed.set_footer(text="Page {}/{} | System ID: {}".format(page + 1, page_count, system.hid))
+    return embed
+
+
 async def system_card(conn, client: discord.Client, system: System) -> discord.Embed:
     card = discord.Embed()
     card.colour = discord.Colour.blue()
@@ -79,7 +98,17 @@ async def system_card(conn, client: discord.Client, system: System) -> discord.E
     if system.tag:
         card.add_field(name="Tag", value=truncate_field_body(system.tag))
 
-    fronters, switch_time = await get_fronters(conn, system.id)
+    # Look the linked accounts up over HTTP while the rest comes from the database
+    account_ids = await system.get_linked_account_ids(conn)
+    accounts_task = asyncio.ensure_future(get_users_cached(client, account_ids))
+    try:
+        fronters, switch_time = await get_fronters(conn, system.id)
+        member_count = await system.get_member_count(conn)
+        first_page = await system.get_members_page(conn, MEMBER_LIST_PAGE_SIZE, 0)
+        accounts = await accounts_task
+    finally:
+        accounts_task.cancel()
+
     if fronters:
         names = ", ".join([member.name for member in fronters])
         fronter_val = "{} (for {})".format(names, humanize.naturaldelta(switch_time))
@@ -87,9 +116,12 @@ async def system_card(conn, client: discord.Client, system: System) -> discord.E
                        value=truncate_field_body(fronter_val))
 
     account_names = []
-    for account_id in await system.get_linked_account_ids(conn):
-        account = await client.get_user_info(account_id)
-        account_names.append("{}#{}".format(account.name, account.discriminator))
+    for account_id, account in zip(account_ids, accounts):
+        if account:
+            account_names.append("{}#{}".format(account.name, account.discriminator))
+        else:
+            # Account was since deleted
+            account_names.append("(deleted account {})".format(account_id))
 
     card.add_field(name="Linked accounts", value=truncate_field_body("\n".join(account_names)))
 
@@ -97,39 +129,19 @@ async def system_card(conn, client: discord.Client, system: System) -> discord.E
         card.add_field(name="Description",
                        value=truncate_field_body(system.description), inline=False)
 
-    # Get names of all members
-    all_members = await system.get_members(conn)
-    if all_members:
-        member_texts = []
-        for member in all_members:
-            member_texts.append("{} (`{}`)".format(escape(member.name), member.hid))
-
-        # Interim solution for pagination of large systems
-        # Previously a lot of systems would hit the 1024 character limit and thus break the message
-        # This splits large system lists into multiple embed fields
-        # The 6000 character total limit will still apply here but this sort of pushes the problem until I find a better fix
-        pages = [""]
-        for member in member_texts:
-            last_page = pages[-1]
-            new_page = last_page + "\n" + member if last_page else member
-
-            if len(new_page) >= 1024:
-                pages.append(member)
-            else:
-                pages[-1] = new_page
-
-        for index, page in enumerate(pages):
-            field_name = "Members"
-            if index >= 1:
-                field_name = "Members (part {})".format(index + 1)
-            card.add_field(name=truncate_field_name(field_name), value=truncate_field_body(page), inline=False)
+    if member_count:
+        # Only the first page, the rest is up to pk;system list
+        members_val = member_list_text(first_page)
+        if member_count > len(first_page):
+            members_val += "\n(and {} more, see `pk;system {} list`)".format(member_count - len(first_page), system.hid)
+        card.add_field(name="Members ({})".format(member_count), value=truncate_field_body(members_val), inline=False)
 
     card.set_footer(text="System ID: {}".format(system.hid))
     return card
 
 
 async def member_card(conn, member: Member) -> discord.Embed:
-    system = await member.fetch_system(conn)
+    system, message_count = await member.fetch_system_and_message_count(conn)
 
     card = discord.Embed()
     card.colour = discord.Colour.blue()
@@ -154,7 +166,6 @@ async def member_card(conn, member: Member) -> discord.Embed:
     if member.pronouns:
         card.add_field(name="Pronouns", value=truncate_field_body(member.pronouns))
 
-    message_count = await member.message_count(conn)
     if message_count > 0:
         card.add_field(name="Message Count", value=str(message_count), inline=True)
 
@@ -172,10 +183,10 @@ async def member_card(conn, member: Member) -> discord.Embed:
     return card
 
 
-async def front_status(ctx: "CommandContext", switch: Switch) -> discord.Embed:
+async def front_status(ctx: "CommandContext", switch: Switch, fronters: List[Member]) -> discord.Embed:
     if switch:
         embed = status("")
-        fronter_names = [member.name for member in await switch.fetch_members(ctx.conn)]
+        fronter_names = [member.name for member in fronters]
 
         if len(fronter_names) == 0:
             embed.add_field(name="Current fronter", value="(no fronter)")
@@ -206,12 +217,12 @@ async def get_message_contents(client: discord.Client, channel_id: int, message_
 
 
 async def message_card(client: discord.Client, message: db.MessageInfo):
-    # Get the original sender of the messages
-    try:
-        original_sender = await client.get_user_info(message.sender)
-    except discord.NotFound:
-        # Account was since deleted - rare but we're handling it anyway
-        original_sender = None
+    # Get the original sender of the messages (None if the account was since deleted - rare but we're handling it anyway),
+    # and the message itself, at the same time
+    original_sender, message_content = await asyncio.gather(
+        get_user_cached(client, message.sender),
+        get_message_contents(client, message.channel, message.mid)
+    )
 
     embed = discord.Embed()
     embed.timestamp = discord.utils.snowflake_time(message.mid)
@@ -232,7 +243,6 @@ async def message_card(client: discord.Client, message: db.MessageInfo):
 
     embed.add_field(name="Sent by", value=sender_name)
 
-    message_content = await get_message_contents(client, message.channel, message.mid)
     embed.description = message_content or "(unknown, message deleted)"
 
     embed.set_author(name=message.name, icon_url=message.avatar_url or discord.Embed.Empty)
@@ -0,0 +1,149 @@
+import asyncio
+import json
+import logging
+from typing import Callable, Optional, Set
+
+import discord
+
+from pluralkit import db
+
+logger = logging.getLogger("pluralkit.bot.gateway")
+
+
+def replace_parser(client: discord.Client, event: str, parser: Callable[[dict], None]) -> Optional[Callable[[dict], None]]:
+    """
+    Swaps out the client's parser for a raw gateway event, returning the previous one.
+
+    The parsers live in a private table of discord.py's connection state - this is written against the discord.py
+    commit pinned in requirements.txt (860d6a9). If it's not there in the expected shape (ie. after upgrading), nothing
+    is replaced and this returns None, so callers carry on unoptimized.
+    """
+    parsers = getattr(getattr(client, "_connection", None), "parsers", None)
+    if not isinstance(parsers, dict) or event not in parsers:
+        logger.warning("Can't replace the {} parser with this discord.py version, skipping".format(event))
+        return None
+
+    previous = parsers[event]
+    parsers[event] = parser
+    return previous
+
+
+class RegisteredAccounts:
+    """
+    The IDs of all accounts linked to a system, kept in memory and up to date through account invalidations.
+
+    This errs on the side of including too many accounts: IDs are added as soon as they change and only removed once
+    the database confirms they're no longer linked.
+    """
+
+    def __init__(self, pool, reload_interval: float = 60 * 60):
+        self.pool = pool
+        self.reload_interval = reload_interval
+        self.account_ids: Set[int] = set()
+        self.loaded = False
+
+    async def reload(self):
+        async with self.pool.acquire() as conn:
+            account_ids = await db.get_all_account_ids(conn)
+        if account_ids is not None:
+            self.account_ids = set(account_ids)
+            self.loaded = True
+
+    async def verify(self, account_id: int):
+        async with self.pool.acquire() as conn:
+            system = await db.get_system_by_account(conn, account_id)
+        if not system:
+            self.account_ids.discard(account_id)
+
+    def invalidate(self, account_id: Optional[int]):
+        if account_id:
+            self.account_ids.add(account_id)
+            asyncio.get_event_loop().create_task(self.verify(account_id))
+        else:
+            asyncio.get_event_loop().create_task(self.reload())
+
+    async def run(self):
+        # Mostly a safety net - invalidations should keep the set current in between
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            try:
+                await self.reload()
+            except Exception:
+                logger.exception("Error reloading registered accounts")
+
+    def __contains__(self, account_id: int) -> bool:
+        return account_id in self.account_ids
+
+    def __len__(self) -> int:
+        return len(self.account_ids)
+
+
+def is_message_candidate(data: dict, accounts: RegisteredAccounts) -> bool:
+    """
+    Checks a raw MESSAGE_CREATE payload for whether on_message could possibly do anything with it - that is, whether
+    it might be a command or a message to proxy. Errs on the side of yes.
+    """
+    author = data.get("author") or {}
+    if author.get("bot") or data.get("webhook_id"):
+        return False
+
+    # Could be a command (the prefix is matched properly later, case insensitively, and mentions may be a nickname mention)
+    content = data.get("content") or ""
+    if content[:3].lower() in ("pk;", "pk!") or content.startswith("<@"):
+        return True
+
+    try:
+        return int(author["id"]) in accounts
+    except (KeyError, ValueError):
+        return True
+
+
+class MessageCreateFilter:
+    """
+    Sits in front of the gateway's MESSAGE_CREATE parser and drops messages that aren't candidates (see
+    is_message_candidate) before they're turned into full Message objects.
+
+    Skipped messages never reach on_message or the message cache, so everything passes through while the registered
+    accounts haven't loaded yet, or while anything is waiting on a message event (eg. a confirmation prompt).
+    """
+
+    def __init__(self, client: discord.Client, accounts: RegisteredAccounts):
+        self.client = client
+        self.accounts = accounts
+        self.parse = None
+        self.passed = 0
+        self.skipped = 0
+
+    def install(self):
+        self.parse = replace_parser(self.client, "MESSAGE_CREATE", self.filter)
+
+    def filter(self, data: dict):
+        if not self.accounts.loaded or self.client._listeners.get("message") or is_message_candidate(data, self.accounts):
+            self.passed += 1
+            self.parse(data)
+        else:
+            self.skipped += 1
+
+
+class PayloadRecorder:
+    """
+    Appends up to `limit` raw MESSAGE_CREATE payloads to a file as JSON lines, for benchmarking the filter with real
+    traffic (see benchmarks/message_filter.py). Message content is cut down to its first few characters.
+    """
+
+    def __init__(self, client: discord.Client, path: str, limit: int = 10000):
+        self.client = client
+        self.path = path
+        self.limit = limit
+        self.recorded = 0
+        self.parse = None
+
+    def install(self):
+        self.parse = replace_parser(self.client, "MESSAGE_CREATE", self.record)
+
+    def record(self, data: dict):
+        if self.recorded < self.limit:
+            self.recorded += 1
+            with open(self.path, "a") as f:
+                f.write(json.dumps(dict(data, content=(data.get("content") or "")[:8])) + "\n")
+        self.parse(data)
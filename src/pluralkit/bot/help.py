@@ -13,6 +13,7 @@ pk;system delete
 pk;system [system] fronter
 pk;system [system] fronthistory
 pk;system [system] frontpercent
+pk;system [system] list
 pk;link <other account>
 pk;unlink
 ```
@@ -23,6 +24,7 @@ member_commands = """
 Commands for adding, removing, and modifying members, as well as adding, removing and moving switches.
 ```
 pk;member new <member name>
+pk;member list
 pk;member <member>
 pk;member <member> rename <new name>
 pk;member <member> description [new description]
@@ -1,14 +1,22 @@
+import asyncio
 import discord
 import logging
 import re
-from typing import Optional
+from typing import List, Optional
 
 from pluralkit import db
+from pluralkit.cache import TTLCache
 from pluralkit.member import Member
 from pluralkit.system import System
 
 logger = logging.getLogger("pluralkit.utils")
 
+# Discord users by ID, or None for IDs that don't belong to any user. Those expire sooner, as they're more likely
+# to be someone trying an ID that doesn't exist yet (or a typo they'll fix)
+USER_CACHE_TTL = 10 * 60
+USER_NOT_FOUND_TTL = 60
+user_cache = TTLCache(ttl=USER_CACHE_TTL)
+
 
 def escape(s):
     return s.replace("`", "\\`")
@@ -24,19 +32,40 @@ def bounds_check_member_name(new_name, system_tag):
                 system_tag)
 
 
+async def get_user_cached(client: discord.Client, user_id: int) -> Optional[discord.User]:
+    """Looks up a user by ID, from the client's own cache, the user cache or the API, in that order."""
+    missing = object()
+    user = user_cache.get(user_id, missing)
+    if user is not missing:
+        return user
+
+    user = client.get_user(user_id)
+    if not user:
+        try:
+            user = await client.get_user_info(user_id)
+        except discord.NotFound:
+            user_cache.set(user_id, None, ttl=USER_NOT_FOUND_TTL)
+            return None
+
+    user_cache.set(user_id, user)
+    return user
+
+
+async def get_users_cached(client: discord.Client, user_ids: List[int]) -> List[Optional[discord.User]]:
+    """Looks up several users at once (see get_user_cached), concurrently. Results are in the same order as the IDs."""
+    return await asyncio.gather(*[get_user_cached(client, user_id) for user_id in user_ids])
+
+
 async def parse_mention(client: discord.Client, mention: str) -> Optional[discord.User]:
     # First try matching mention format
     match = re.fullmatch("<@!?(\\d+)>", mention)
     if match:
-        try:
-            return await client.get_user_info(int(match.group(1)))
-        except discord.NotFound:
-            return None
+        return await get_user_cached(client, int(match.group(1)))
 
     # Then try with just ID
     try:
-        return await client.get_user_info(int(mention))
-    except (ValueError, discord.NotFound):
+        return await get_user_cached(client, int(mention))
+    except ValueError:
         return None
 
 
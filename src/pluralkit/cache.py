@@ -0,0 +1,105 @@
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+
+class TTLCache:
+    """
+    A small in-memory cache with per-entry expiry and least-recently-used eviction.
+
+    Entries expire `ttl` seconds after being set (never, if `ttl` is None). Once there are more than `max_size`
+    entries, the least recently used ones are evicted. `None` is a valid value, so misses can be cached too -
+    use `key in cache` or a `default` sentinel to tell them apart from cache misses.
+    """
+
+    def __init__(self, ttl: Optional[float], max_size: int = 10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+
+        value, expires = entry
+        if expires is not None and expires < time.monotonic():
+            del self._entries[key]
+            return default
+
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        """Stores a value, optionally with a different TTL than the cache's own."""
+        ttl = ttl if ttl is not None else self.ttl
+        self._entries[key] = (value, time.monotonic() + ttl if ttl is not None else None)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __contains__(self, key: Hashable) -> bool:
+        missing = object()
+        return self.get(key, missing) is not missing
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SizedLRUCache:
+    """
+    A least-recently-used cache of byte strings, bounded by their total size rather than by entry count.
+
+    Every entry is stored along with a version, and only returned when asked for that same version.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+
+    def get(self, key: Hashable, version: Hashable) -> Optional[bytes]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        entry_version, value = entry
+        if entry_version != version:
+            # Outdated, won't be asked for again
+            self.invalidate(key)
+            return None
+
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, version: Hashable, value: bytes):
+        # Never worth caching something that would push out everything else
+        if len(value) > self.max_bytes // 4:
+            return
+
+        self.invalidate(key)
+        self._entries[key] = (version, value)
+        self.size += len(value)
+
+        while self.size > self.max_bytes:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    def invalidate(self, key: Hashable):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
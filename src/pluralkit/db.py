@@ -1,7 +1,12 @@
+import asyncio
 from collections import namedtuple
-from datetime import datetime
+from datetime import date, datetime, timedelta, timezone
+import gzip
+import json
 import logging
-from typing import List, Optional
+import os
+import re
+from typing import Callable, Dict, List, Optional, Tuple
 import time
 
 import asyncpg
@@ -10,16 +15,39 @@ from discord.utils import snowflake_time
 
 from pluralkit.system import System
 from pluralkit.member import Member
+from pluralkit.switch import Switch
+from pluralkit.utils import generate_hid, hash_token
 
 logger = logging.getLogger("pluralkit.db")
+# Connections per pool (so per process), see README for how they add up
+POOL_SIZE = int(os.environ.get("DATABASE_POOL_SIZE") or 10)
+
+# Whether the pg_trgm extension is installed, which fuzzy member search (search_members) needs
+# Checked on connect, and again once migrate_tables has tried to install it
+has_pg_trgm = False
+
+
 async def connect(username, password, database, host, port):
     while True:
         try:
-            return await asyncpg.create_pool(user=username, password=password, database=database, host=host, port=port)
+            pool = await asyncpg.create_pool(user=username, password=password, database=database, host=host, port=port,
+                                             min_size=POOL_SIZE, max_size=POOL_SIZE)
+            break
         except (ConnectionError, asyncpg.exceptions.CannotConnectNowError):
             logger.exception("Failed to connect to database, retrying in 5 seconds...")
             time.sleep(5)
 
+    async with pool.acquire() as conn:
+        await detect_extensions(conn)
+    return pool
+
+
+async def detect_extensions(conn):
+    global has_pg_trgm
+    has_pg_trgm = await conn.fetchval("select exists (select 1 from pg_extension where extname = 'pg_trgm')")
+    if not has_pg_trgm:
+        logger.warning("pg_trgm is not installed, fuzzy member search is disabled")
+
 def db_wrap(func):
     async def inner(*args, **kwargs):
         before = time.perf_counter()
@@ -33,32 +61,247 @@ def db_wrap(func):
             logger.exception("Error from database query {}".format(func.__name__))
     return inner
 
+# Cross-process cache invalidation
+# Writers NOTIFY on this channel with an "entity:id" payload, and every process listens on it (see listen_for_invalidations)
+# and passes the ID to the invalidators registered for that entity. Entities are:
+# - system (system ID): the system, or anything shown as part of it (eg. its member list), changed or was deleted
+# - member (member ID): the member changed or was deleted
+# - switch (system ID): the system's switch history changed
+# - account (account ID): the account was linked to or unlinked from a system
+# - webhook (channel ID), server (server ID): the stored webhook or server settings changed
+INVALIDATION_CHANNEL = "pluralkit_invalidate"
+
+invalidators: Dict[str, List[Callable[[Optional[int]], None]]] = {}
+
+
+def register_invalidator(entity: str, invalidator: Callable[[Optional[int]], None]):
+    """
+    Registers a function to be called with an entity's ID whenever that entity changes, in any process.
+    It also gets called with None after (re)connecting the listener, meaning anything could have changed.
+    """
+    invalidators.setdefault(entity, []).append(invalidator)
+
+
+def dispatch_invalidation(entity: str, entity_id: Optional[int]):
+    for invalidator in invalidators.get(entity, []):
+        try:
+            invalidator(entity_id)
+        except Exception:
+            logger.exception("Error in {} invalidator".format(entity))
+
+
+async def notify_invalidate(conn, entity: str, entity_id: int):
+    # Notifications are only sent once (and if) the surrounding transaction commits
+    await conn.execute("select pg_notify($1, $2)", INVALIDATION_CHANNEL, "{}:{}".format(entity, entity_id))
+
+
+def handle_invalidation_notification(conn, pid, channel, payload):
+    entity, _, entity_id = payload.partition(":")
+    try:
+        dispatch_invalidation(entity, int(entity_id))
+    except ValueError:
+        logger.warning("Got malformed invalidation payload {}".format(payload))
+
+
+# Switch events, for pushing switch changes to API clients as they happen
+# Changes are NOTIFYed on this channel as JSON, and dispatched to handlers (in every process, including the one that
+# made the change) once the notification comes back through the listener - which only happens after the transaction
+# commits, however deeply it's nested, and never for one that rolls back
+SWITCH_EVENT_CHANNEL = "pluralkit_switch_events"
+
+switch_event_handlers: List[Callable[["SwitchEvent"], None]] = []
+
+
+class SwitchEvent(namedtuple("SwitchEvent", ["type", "system", "switch"])):
+    # One of "added", "moved" or "deleted"
+    type: str
+    system: int
+    switch: int
+
+
+def register_switch_event_handler(handler: Callable[[SwitchEvent], None]):
+    """Registers a function to be called with every switch added, moved or deleted, in any process."""
+    switch_event_handlers.append(handler)
+
+
+def dispatch_switch_event(event: SwitchEvent):
+    for handler in switch_event_handlers:
+        try:
+            handler(event)
+        except Exception:
+            logger.exception("Error in switch event handler")
+
+
+async def notify_switch_event(conn, event: SwitchEvent):
+    # Like invalidations, only sent once the surrounding transaction commits
+    payload = json.dumps({"type": event.type, "system": event.system, "switch": event.switch})
+    await conn.execute("select pg_notify($1, $2)", SWITCH_EVENT_CHANNEL, payload)
+
+
+def handle_switch_event_notification(conn, pid, channel, payload):
+    try:
+        data = json.loads(payload)
+        event = SwitchEvent(type=data["type"], system=int(data["system"]), switch=int(data["switch"]))
+    except (ValueError, KeyError, TypeError):
+        logger.warning("Got malformed switch event payload {}".format(payload))
+        return
+    dispatch_switch_event(event)
+
+
+async def listen_for_invalidations(username, password, database, host, port):
+    """
+    Keeps a dedicated connection listening for invalidations (and switch events) forever, reconnecting and resyncing if it drops.
+    """
+    while True:
+        try:
+            conn = await asyncpg.connect(user=username, password=password, database=database, host=host, port=port)
+        except (OSError, asyncpg.exceptions.PostgresError):
+            logger.exception("Failed to connect invalidation listener, retrying in 5 seconds...")
+            await asyncio.sleep(5)
+            continue
+
+        try:
+            await conn.add_listener(INVALIDATION_CHANNEL, handle_invalidation_notification)
+            await conn.add_listener(SWITCH_EVENT_CHANNEL, handle_switch_event_notification)
+
+            # We may have missed notifications while disconnected, so everything's suspect
+            for entity in invalidators:
+                dispatch_invalidation(entity, None)
+
+            # Ping every so often, so a dead connection gets noticed
+            while True:
+                await asyncio.sleep(30)
+                await asyncio.wait_for(conn.execute("select 1"), timeout=10)
+        except (OSError, asyncio.TimeoutError, asyncpg.exceptions.PostgresError, asyncpg.exceptions.InterfaceError):
+            logger.exception("Invalidation listener connection lost, reconnecting...")
+        finally:
+            if not conn.is_closed():
+                conn.terminate()
+
+
+# HIDs are handed out from a pool of pre-generated, unused ones, shared by systems and members
+# Taking one is a single statement (which can be a CTE of the insert using it), and never collides
+# HIDs reserved ahead of time (see reserve_hids) can, since the pool may hand them out again once they're taken from it
+# and still unused, so inserts using those fall back to the pool on a conflict
+HID_POOL_TARGET = 10000
+HID_POOL_LOW = 1000
+
+ALLOCATE_HID_QUERY = "delete from hid_pool where hid = (select hid from hid_pool limit 1 for update skip locked) returning hid"
+
+
+async def fill_hid_pool(conn, count: int):
+    """Adds up to `count` new random HIDs to the pool, skipping ones that are already taken."""
+    candidates = list({generate_hid() for _ in range(count)})
+    await conn.execute("""insert into hid_pool (hid)
+    select candidates.hid from unnest($1::char(5)[]) as candidates(hid)
+    where not exists (select 1 from systems where systems.hid = candidates.hid)
+        and not exists (select 1 from members where members.hid = candidates.hid)
+    on conflict do nothing""", candidates)
+
+
+async def refill_hid_pool(conn):
+    """Tops the pool back up to its target size, if it's running low."""
+    size = await conn.fetchval("select count(*) from hid_pool")
+    if size < HID_POOL_LOW:
+        logger.info("Refilling HID pool ({} left)".format(size))
+        await fill_hid_pool(conn, HID_POOL_TARGET - size)
+
+
+async def fetchrow_with_hid(conn, query: str, *args):
+    """
+    Runs a query taking a HID from the pool (see ALLOCATE_HID_QUERY) that returns nothing if the pool was empty,
+    refilling it and trying again in that case.
+    """
+    row = await conn.fetchrow(query, *args)
+    if not row:
+        await fill_hid_pool(conn, HID_POOL_LOW)
+        row = await conn.fetchrow(query, *args)
+    return row
+
+
 @db_wrap
-async def create_system(conn, system_name: str, system_hid: str) -> System:
+async def reserve_hids(conn, count: int) -> List[str]:
+    """
+    Takes `count` HIDs out of the pool, for bulk creation (eg. imports).
+
+    Until they're used, a refill can put the same HIDs back in the pool, so they're not guaranteed to be free.
+    """
+    hids = []
+    while len(hids) < count:
+        rows = await conn.fetch("""delete from hid_pool where hid in (
+            select hid from hid_pool limit $1 for update skip locked
+        ) returning hid""", count - len(hids))
+        hids.extend(row["hid"] for row in rows)
+
+        if len(hids) < count:
+            await fill_hid_pool(conn, max(count - len(hids), HID_POOL_LOW))
+    return hids
+
+
+@db_wrap
+async def create_system(conn, system_name: str, system_hid: Optional[str] = None) -> System:
     logger.debug("Creating system (name={}, hid={})".format(
         system_name, system_hid))
-    row = await conn.fetchrow("insert into systems (name, hid) values ($1, $2) returning *", system_name, system_hid)
+    if system_hid:
+        row = await conn.fetchrow("insert into systems (name, hid) values ($1, $2) returning *", system_name, system_hid)
+    else:
+        row = await fetchrow_with_hid(conn, """with allocated as ({})
+        insert into systems (name, hid) select $1, hid from allocated returning *""".format(ALLOCATE_HID_QUERY), system_name)
     return System(**row) if row else None
 
 
 @db_wrap
 async def remove_system(conn, system_id: int):
     logger.debug("Deleting system (id={})".format(system_id))
+    # The system's accounts go with it (on delete cascade), which account listeners need to hear about too
+    account_ids = await conn.fetch("select uid from accounts where system = $1", system_id)
     await conn.execute("delete from systems where id = $1", system_id)
+    await notify_invalidate(conn, "system", system_id)
+    for row in account_ids:
+        await notify_invalidate(conn, "account", row["uid"])
 
 
 @db_wrap
-async def create_member(conn, system_id: int, member_name: str, member_hid: str) -> Member:
+async def create_member(conn, system_id: int, member_name: str, member_hid: Optional[str] = None) -> Member:
     logger.debug("Creating member (system={}, name={}, hid={})".format(
         system_id, member_name, member_hid))
-    row = await conn.fetchrow("insert into members (name, system, hid) values ($1, $2, $3) returning *", member_name, system_id, member_hid)
+    query = """with allocated as ({}), created as (
+        insert into members (name, system, hid) select $1, $2, hid from allocated on conflict (hid) do nothing returning *
+    ), touched as (
+        update systems set updated = (clock_timestamp() at time zone 'utc') where id = $2 and exists (select 1 from created)
+    )
+    select * from created"""
+    row = None
+    if member_hid:
+        row = await conn.fetchrow(query.format("select $3::char(5) as hid"), member_name, system_id, member_hid)
+        if not row:
+            # Someone else got the reserved HID first, take a fresh one instead
+            logger.debug("Reserved HID {} already taken, allocating another".format(member_hid))
+    if not row:
+        row = await fetchrow_with_hid(conn, query.format(ALLOCATE_HID_QUERY), member_name, system_id)
+    await notify_invalidate(conn, "system", system_id)
     return Member(**row) if row else None
 
 
+@db_wrap
+async def get_first_switch_timestamp_with_member(conn, member_id: int) -> Optional[datetime]:
+    return await conn.fetchval("""select min(switches.timestamp)
+    from switch_members join switches on switches.id = switch_members.switch
+    where switch_members.member = $1""", member_id)
+
+
 @db_wrap
 async def delete_member(conn, member_id: int):
     logger.debug("Deleting member (id={})".format(member_id))
-    await conn.execute("delete from members where id = $1", member_id)
+    system_id = await conn.fetchval("""with deleted as (
+        delete from members where id = $1 returning system
+    )
+    update systems set updated = (clock_timestamp() at time zone 'utc')
+    from deleted where systems.id = deleted.system
+    returning systems.id""", member_id)
+    await notify_invalidate(conn, "member", member_id)
+    if system_id:
+        await notify_invalidate(conn, "system", system_id)
 
 
 @db_wrap
@@ -66,6 +309,7 @@ async def link_account(conn, system_id: int, account_id: int):
     logger.debug("Linking account (account_id={}, system_id={})".format(
         account_id, system_id))
     await conn.execute("insert into accounts (uid, system) values ($1, $2)", account_id, system_id)
+    await notify_invalidate(conn, "account", account_id)
 
 
 @db_wrap
@@ -73,6 +317,12 @@ async def unlink_account(conn, system_id: int, account_id: int):
     logger.debug("Unlinking account (account_id={}, system_id={})".format(
         account_id, system_id))
     await conn.execute("delete from accounts where uid = $1 and system = $2", account_id, system_id)
+    await notify_invalidate(conn, "account", account_id)
+
+
+@db_wrap
+async def get_all_account_ids(conn) -> List[int]:
+    return [row["uid"] for row in await conn.fetch("select uid from accounts")]
 
 
 @db_wrap
@@ -87,7 +337,7 @@ async def get_system_by_account(conn, account_id: int) -> System:
 
 @db_wrap
 async def get_system_by_token(conn, token: str) -> Optional[System]:
-    row = await conn.fetchrow("select * from systems where token = $1", token)
+    row = await conn.fetchrow("select * from systems where token_hash = $1", hash_token(token))
     return System(**row) if row else None
 
 @db_wrap
@@ -108,6 +358,31 @@ async def get_member_by_name(conn, system_id: int, member_name: str) -> Member:
     return Member(**row) if row else None
 
 
+@db_wrap
+async def search_members(conn, system_id: int, query: str, limit: int) -> List[Tuple[Member, float]]:
+    """
+    Returns the members of a system whose names are similar to the query (by trigrams), best matches first.
+    Always empty if pg_trgm isn't installed.
+    """
+    if not has_pg_trgm:
+        return []
+
+    # Scored by whichever is higher of similarity to the whole name, and to the best-matching part of it
+    # (so searching for a first name still finds someone by their full name)
+    rows = await conn.fetch("""select members.*, greatest(similarity(lower(name), lower($2)), word_similarity(lower($2), lower(name))) as score
+    from members
+    where system = $1 and (lower(name) % lower($2) or lower($2) <% lower(name))
+    order by score desc, lower(name), id
+    limit $3""", system_id, query, limit)
+
+    results = []
+    for row in rows:
+        member = dict(row)
+        score = member.pop("score")
+        results.append((Member(**member), score))
+    return results
+
+
 @db_wrap
 async def get_member_by_hid_in_system(conn, system_id: int, member_hid: str) -> Member:
     row = await conn.fetchrow("select * from members where system = $1 and hid = $2", system_id, member_hid)
@@ -130,18 +405,68 @@ async def get_members(conn, members: list) -> List[Member]:
     rows = await conn.fetch("select * from members where id = any($1)", members)
     return [Member(**row) for row in rows]
 
+@db_wrap
+async def get_systems_by_hids(conn, system_hids: List[str]) -> List[System]:
+    rows = await conn.fetch("select * from systems where hid = any($1)", system_hids)
+    return [System(**row) for row in rows]
+
+@db_wrap
+async def get_members_by_hids(conn, member_hids: List[str]) -> List[Member]:
+    rows = await conn.fetch("select * from members where hid = any($1)", member_hids)
+    return [Member(**row) for row in rows]
+
+@db_wrap
+async def get_members_of_systems(conn, system_ids: List[int]) -> List[Member]:
+    rows = await conn.fetch("select * from members where system = any($1)", system_ids)
+    return [Member(**row) for row in rows]
+
+class SystemVersion(namedtuple("SystemVersion", ["id", "updated", "current_switch", "switch_timestamp"])):
+    id: int
+    # Last change to the system or any of its members
+    updated: datetime
+    current_switch: Optional[int]
+    switch_timestamp: Optional[datetime]
+
+
+@db_wrap
+async def get_system_version(conn, system_hid: str) -> Optional[SystemVersion]:
+    """Fetches just enough of a system to tell whether it (or its switches) changed, for cheap HTTP revalidation."""
+    row = await conn.fetchrow("""select
+        systems.id, systems.updated, systems.current_switch, switches.timestamp as switch_timestamp
+    from systems
+    left join switches on switches.id = systems.current_switch
+    where systems.hid = $1""", system_hid)
+    return SystemVersion(**row) if row else None
+
+
+@db_wrap
+async def get_member_version(conn, member_hid: str) -> Optional[Tuple[int, datetime]]:
+    row = await conn.fetchrow("select id, updated from members where hid = $1", member_hid)
+    return (row["id"], row["updated"]) if row else None
+
+
 @db_wrap
 async def update_system_field(conn, system_id: int, field: str, value):
     logger.debug("Updating system field (id={}, {}={})".format(
         system_id, field, value))
-    await conn.execute("update systems set {} = $1 where id = $2".format(field), value, system_id)
+    await conn.execute("update systems set {} = $1, updated = (clock_timestamp() at time zone 'utc') where id = $2".format(field), value, system_id)
+    await notify_invalidate(conn, "system", system_id)
 
 
 @db_wrap
 async def update_member_field(conn, member_id: int, field: str, value):
     logger.debug("Updating member field (id={}, {}={})".format(
         member_id, field, value))
-    await conn.execute("update members set {} = $1 where id = $2".format(field), value, member_id)
+    # The system's member list includes this member, so that counts as the system changing too
+    system_id = await conn.fetchval("""with updated_member as (
+        update members set {} = $1, updated = (clock_timestamp() at time zone 'utc') where id = $2 returning system
+    )
+    update systems set updated = (clock_timestamp() at time zone 'utc')
+    from updated_member where systems.id = updated_member.system
+    returning systems.id""".format(field), value, member_id)
+    await notify_invalidate(conn, "member", member_id)
+    if system_id:
+        await notify_invalidate(conn, "system", system_id)
 
 
 @db_wrap
@@ -149,6 +474,17 @@ async def get_all_members(conn, system_id: int) -> List[Member]:
     rows = await conn.fetch("select * from members where system = $1", system_id)
     return [Member(**row) for row in rows]
 
+@db_wrap
+async def get_members_page(conn, system_id: int, limit: int, offset: int) -> List[Member]:
+    # Alphabetical, with the ID breaking ties so pages don't overlap
+    rows = await conn.fetch("select * from members where system = $1 order by lower(name), id limit $2 offset $3",
+                            system_id, limit, offset)
+    return [Member(**row) for row in rows]
+
+@db_wrap
+async def get_member_count(conn, system_id: int) -> int:
+    return await conn.fetchval("select count(*) from members where system = $1", system_id)
+
 @db_wrap
 async def get_members_exceeding(conn, system_id: int, length: int) -> List[Member]:
     rows = await conn.fetch("select * from members where system = $1 and length(name) > $2", system_id, length)
@@ -166,16 +502,23 @@ async def add_webhook(conn, channel_id: int, webhook_id: int, webhook_token: str
     logger.debug("Adding new webhook (channel={}, webhook={}, token={})".format(
         channel_id, webhook_id, webhook_token))
     await conn.execute("insert into webhooks (channel, webhook, token) values ($1, $2, $3)", channel_id, webhook_id, webhook_token)
+    await notify_invalidate(conn, "webhook", channel_id)
 
 @db_wrap
 async def delete_webhook(conn, channel_id: int):
     await conn.execute("delete from webhooks where channel = $1", channel_id)
+    await notify_invalidate(conn, "webhook", channel_id)
 
 @db_wrap
 async def add_message(conn, message_id: int, channel_id: int, member_id: int, sender_id: int):
     logger.debug("Adding new message (id={}, channel={}, member={}, sender={})".format(
         message_id, channel_id, member_id, sender_id))
-    await conn.execute("insert into messages (mid, channel, member, sender) values ($1, $2, $3, $4)", message_id, channel_id, member_id, sender_id)
+    # Bump the member's message counter in the same statement so the two never drift apart
+    await conn.execute("""with inserted as (
+        insert into messages (mid, channel, member, sender) values ($1, $2, $3, $4) returning member
+    )
+    insert into member_stats (member, message_count) select member, 1 from inserted
+    on conflict (member) do update set message_count = member_stats.message_count + 1""", message_id, channel_id, member_id, sender_id)
 
 class ProxyMember(namedtuple("ProxyMember", ["id", "hid", "prefix", "suffix", "color", "name", "avatar_url", "tag", "system_name", "system_hid"])):
     id: int
@@ -224,6 +567,30 @@ class MessageInfo(namedtuple("MemberInfo", ["mid", "channel", "member", "sender"
             "timestamp": snowflake_time(self.mid).isoformat()
         }
 
+# Discord snowflakes encode milliseconds since this epoch in their upper 42 bits
+DISCORD_EPOCH = 1420070400000
+
+
+def snowflake_from_time(dt: datetime) -> int:
+    """Returns the lowest possible snowflake for the given naive UTC datetime."""
+    ms = int(dt.replace(tzinfo=timezone.utc).timestamp() * 1000) - DISCORD_EPOCH
+    return max(ms, 0) << 22
+
+
+def message_horizon() -> Optional[datetime]:
+    """Returns the retention horizon for proxied messages (from MESSAGE_RETENTION_DAYS), or None if they're kept forever."""
+    days = os.environ.get("MESSAGE_RETENTION_DAYS")
+    if not days:
+        return None
+    return datetime.utcnow() - timedelta(days=int(days))
+
+
+def message_horizon_mid() -> int:
+    """Returns the lowest message ID still within the retention horizon. Also lets Postgres prune old partitions."""
+    horizon = message_horizon()
+    return snowflake_from_time(horizon) if horizon else 0
+
+
 @db_wrap
 async def get_message_by_sender_and_id(conn, message_id: int, sender_id: int) -> MessageInfo:
     row = await conn.fetchrow("""select
@@ -236,7 +603,8 @@ async def get_message_by_sender_and_id(conn, message_id: int, sender_id: int) ->
         messages.member = members.id
         and members.system = systems.id
         and mid = $1
-        and sender = $2""", message_id, sender_id)
+        and sender = $2
+        and mid >= $3""", message_id, sender_id, message_horizon_mid())
     return MessageInfo(**row) if row else None
 
 
@@ -251,53 +619,302 @@ async def get_message(conn, message_id: int) -> MessageInfo:
     where
         messages.member = members.id
         and members.system = systems.id
-        and mid = $1""", message_id)
+        and mid = $1
+        and mid >= $2""", message_id, message_horizon_mid())
     return MessageInfo(**row) if row else None
 
 
 @db_wrap
 async def delete_message(conn, message_id: int):
     logger.debug("Deleting message (id={})".format(message_id))
-    await conn.execute("delete from messages where mid = $1", message_id)
+    await conn.execute("""with deleted as (
+        delete from messages where mid = $1 returning member
+    )
+    update member_stats set message_count = message_count - 1
+    from deleted where member_stats.member = deleted.member""", message_id)
 
 @db_wrap
 async def get_member_message_count(conn, member_id: int) -> int:
-    return await conn.fetchval("select count(*) from messages where member = $1", member_id)
+    return await conn.fetchval("select coalesce((select message_count from member_stats where member = $1), 0)", member_id)
+
+@db_wrap
+async def get_member_system_and_message_count(conn, member_id: int) -> Optional[Tuple[System, int]]:
+    row = await conn.fetchrow("""select systems.*, coalesce(member_stats.message_count, 0) as member_message_count
+    from members
+        join systems on systems.id = members.system
+        left join member_stats on member_stats.member = members.id
+    where members.id = $1""", member_id)
+    if not row:
+        return None
+
+    system = dict(row)
+    message_count = system.pop("member_message_count")
+    return System(**system), message_count
+
+@db_wrap
+async def get_member_message_counts(conn, member_ids: List[int]) -> Dict[int, int]:
+    rows = await conn.fetch("select member, message_count from member_stats where member = any($1)", member_ids)
+    return {row["member"]: row["message_count"] for row in rows}
 
 @db_wrap
 async def front_history(conn, system_id: int, count: int):
     return await conn.fetch("""select
         switches.*,
-        array(
-            select member from switch_members
-            where switch_members.switch = switches.id
-            order by switch_members.id asc
+        coalesce(
+            array_agg(switch_members.member order by switch_members.id) filter (where switch_members.member is not null),
+            '{}'
         ) as members
-    from switches
-    where switches.system = $1
-    order by switches.timestamp desc
-    limit $2""", system_id, count)
+    from (
+        select * from switches
+        where switches.system = $1
+        order by switches.timestamp desc
+        limit $2
+    ) as switches
+    left join switch_members on switch_members.switch = switches.id
+    group by switches.id, switches.system, switches.timestamp
+    order by switches.timestamp desc""", system_id, count)
+
+
+def member_from_row(row) -> Optional[Member]:
+    """Builds a Member out of a joined row containing (at least) all member columns. Returns None if the join came up empty."""
+    if row["id"] is None:
+        return None
+    return Member(**{field: row[field] for field in Member._fields})
+
+
+def group_switch_rows(rows) -> List[Tuple[Switch, List[Member]]]:
+    """Groups rows of (switch_id, switch_system, switch_timestamp, members.*), ordered by switch, into switches with members."""
+    out = []
+    for row in rows:
+        if not out or out[-1][0].id != row["switch_id"]:
+            out.append((Switch(id=row["switch_id"], system=row["switch_system"], timestamp=row["switch_timestamp"], members=[]), []))
+
+        member = member_from_row(row)
+        if member:
+            out[-1][0].members.append(member.id)
+            out[-1][1].append(member)
+    return out
+
+
+FRONT_HISTORY_WITH_MEMBERS_QUERY = """select
+        switches.id as switch_id, switches.system as switch_system, switches.timestamp as switch_timestamp,
+        members.*
+    from (
+        select * from switches
+        where
+            switches.system = $1
+            -- Without an ID to break ties with, this is a plain timestamp < $3
+            and ($3::timestamp is null or (switches.timestamp, switches.id) < ($3, $6::int))
+            and ($4::timestamp is null or switches.timestamp >= $4)
+            and ($5::timestamp is null or switches.timestamp <= $5)
+        order by switches.timestamp desc, switches.id desc
+        limit $2
+    ) as switches
+    left join switch_members on switch_members.switch = switches.id
+    left join members on members.id = switch_members.member
+    order by switches.timestamp desc, switches.id desc, switch_members.id asc"""
+
+
+@db_wrap
+async def front_history_with_members(conn, system_id: int, count: Optional[int], before: Optional[datetime] = None,
+                                     start: Optional[datetime] = None, end: Optional[datetime] = None,
+                                     before_id: Optional[int] = None) -> List[Tuple[Switch, List[Member]]]:
+    """
+    Returns the latest `count` switches of a system along with their (ordered) members, in a single query.
+
+    `before` and `before_id` are an exclusive upper bound on (timestamp, switch ID) for keyset pagination, so switches
+    sharing a timestamp aren't skipped. `start` and `end` are an inclusive time range.
+    """
+    rows = await conn.fetch(FRONT_HISTORY_WITH_MEMBERS_QUERY, system_id, count, before, start, end, before_id)
+    return group_switch_rows(rows)
+
 
 @db_wrap
-async def add_switch(conn, system_id: int):
-    logger.debug("Adding switch (system={})".format(system_id))
-    res = await conn.fetchrow("insert into switches (system) values ($1) returning *", system_id)
-    return res["id"]
+async def get_current_switch(conn, system_id: int) -> Optional[Switch]:
+    row = await conn.fetchrow("""select
+        switches.*,
+        coalesce(
+            array_agg(switch_members.member order by switch_members.id) filter (where switch_members.member is not null),
+            '{}'
+        ) as members
+    from systems
+    join switches on switches.id = systems.current_switch
+    left join switch_members on switch_members.switch = switches.id
+    where systems.id = $1
+    group by switches.id""", system_id)
+    return Switch(**row) if row else None
+
 
 @db_wrap
-async def move_switch(conn, system_id: int, switch_id: int, new_time: datetime):
-    logger.debug("Moving latest switch (system={}, id={}, new_time={})".format(system_id, switch_id, new_time))
-    await conn.execute("update switches set timestamp = $1 where system = $2 and id = $3", new_time, system_id, switch_id)
+async def get_current_switch_with_members(conn, system_id: int) -> Optional[Tuple[Switch, List[Member]]]:
+    rows = await conn.fetch("""select
+        switches.id as switch_id, switches.system as switch_system, switches.timestamp as switch_timestamp,
+        members.*
+    from systems
+    join switches on switches.id = systems.current_switch
+    left join switch_members on switch_members.switch = switches.id
+    left join members on members.id = switch_members.member
+    where systems.id = $1
+    order by switch_members.id asc""", system_id)
+    switches = group_switch_rows(rows)
+    return switches[0] if switches else None
+
+
+@db_wrap
+async def front_breakdown(conn, system_id: int, since: datetime, until: datetime) -> Tuple[List[Tuple[Optional[Member], timedelta]], Optional[datetime]]:
+    """
+    Sums up how long each member fronted between `since` and `until`, clipping switches to that range.
+    Time with no fronter is returned with a member of None.
+
+    Returns the per-member totals, and the start of the covered span (which can be after `since` if the first switch is).
+    """
+    rows = await conn.fetch("""with ranged as (
+        -- Every switch overlapping the range, starting from the one active at its start
+        select id, timestamp, lead(timestamp) over (order by timestamp) as next_timestamp
+        from switches
+        where
+            system = $1
+            and timestamp >= coalesce((select max(timestamp) from switches where system = $1 and timestamp <= $2), '-infinity')
+            and timestamp < $3
+    ), clipped as (
+        select id, greatest(timestamp, $2) as start_time, least(coalesce(next_timestamp, $3), $3) as end_time
+        from ranged
+    )
+    select
+        members.*,
+        sum(clipped.end_time - clipped.start_time) as front_time,
+        (select min(start_time) from clipped) as span_start
+    from clipped
+    left join switch_members on switch_members.switch = clipped.id
+    left join members on members.id = switch_members.member
+    group by members.id
+    order by front_time desc""", system_id, since, until)
+
+    if not rows:
+        return [], None
+    return [(member_from_row(row), row["front_time"]) for row in rows], rows[0]["span_start"]
+
+
+@db_wrap
+async def get_front_span_start(conn, system_id: int, since: datetime) -> Optional[datetime]:
+    """Returns when switch history coverage starts from `since` onward - `since` itself if a switch was active then, else the first switch after it."""
+    return await conn.fetchval("""select case
+        when exists (select 1 from switches where system = $1 and timestamp <= $2) then $2
+        else (select min(timestamp) from switches where system = $1 and timestamp > $2)
+    end""", system_id, since)
+
+
+@db_wrap
+async def refresh_front_rollup(conn, system_id: int, since: datetime):
+    """
+    Recomputes the daily front time rollup of a system for every day from the day of `since` onward.
+
+    Only switches that have ended (ie. aren't the latest one) count towards the rollup, so it only needs
+    refreshing when switch history changes, from the earliest point that changed.
+    """
+    day = since.date()
+    async with conn.transaction():
+        # Concurrent refreshes of the same system would each delete only the rows committed before they started, and
+        # then both insert theirs - so they take turns, holding the lock until the surrounding transaction ends
+        await conn.execute("select 1 from systems where id = $1 for no key update", system_id)
+        await conn.execute("delete from front_daily where system = $1 and day >= $2", system_id, day)
+        await conn.execute("""with ranged as (
+            select id, timestamp, lead(timestamp) over (order by timestamp) as next_timestamp
+            from switches
+            where
+                system = $1
+                and timestamp >= coalesce((select max(timestamp) from switches where system = $1 and timestamp <= $2), '-infinity')
+        ), closed as (
+            select id, greatest(timestamp, $2) as start_time, next_timestamp as end_time
+            from ranged
+            where next_timestamp is not null and next_timestamp > $2
+        ), days as (
+            -- Split every switch into one row per day it covers
+            select
+                closed.id, day_start::date as day,
+                extract(epoch from least(closed.end_time, day_start + interval '1 day') - greatest(closed.start_time, day_start)) as seconds
+            from closed, generate_series(date_trunc('day', closed.start_time), closed.end_time, interval '1 day') as day_start
+        )
+        insert into front_daily (system, member, day, seconds)
+        select $1, switch_members.member, days.day, sum(days.seconds)
+        from days
+        left join switch_members on switch_members.switch = days.id
+        where days.seconds > 0
+        group by switch_members.member, days.day
+        on conflict (system, member, day) do update set seconds = excluded.seconds""", system_id, datetime.combine(day, datetime.min.time()))
+
+
+@db_wrap
+async def front_rollup_breakdown(conn, system_id: int, since_day: date) -> List[Tuple[Optional[Member], timedelta]]:
+    """Sums up the rolled up front time of each member from `since_day` onward. Only covers switches that have ended."""
+    rows = await conn.fetch("""select
+        members.*,
+        sum(front_daily.seconds) as seconds
+    from front_daily
+    left join members on members.id = front_daily.member
+    where front_daily.system = $1 and front_daily.day >= $2
+    group by members.id""", system_id, since_day)
+    return [(member_from_row(row), timedelta(seconds=row["seconds"])) for row in rows]
+
+
+@db_wrap
+async def has_front_rollup(conn, system_id: int) -> bool:
+    return await conn.fetchval("select exists (select 1 from front_daily where system = $1)", system_id)
+
+
+async def backfill_front_rollup(conn):
+    """Builds the daily front time rollup for every system that has switches but no rollup rows yet."""
+    # Only one process needs to do this, the rest can skip it
+    if not await conn.fetchval("select pg_try_advisory_lock(2939031)"):
+        return
+    try:
+        system_ids = await conn.fetch("""select distinct system from switches
+            where not exists (select 1 from front_daily where front_daily.system = switches.system)""")
+        if system_ids:
+            logger.info("Backfilling front time rollup for {} systems".format(len(system_ids)))
+        for row in system_ids:
+            await refresh_front_rollup(conn, row["system"], datetime.min)
+    finally:
+        await conn.execute("select pg_advisory_unlock(2939031)")
+
+
+async def update_current_switch(conn, system_id: int):
+    # Points the system's current switch at its latest one, if any
+    await conn.execute("""update systems set current_switch = (
+        select id from switches where switches.system = systems.id order by timestamp desc limit 1
+    ) where id = $1""", system_id)
+
 
 @db_wrap
-async def add_switch_member(conn, switch_id: int, member_id: int):
-    logger.debug("Adding switch member (switch={}, member={})".format(switch_id, member_id))
-    await conn.execute("insert into switch_members (switch, member) values ($1, $2)", switch_id, member_id)
+async def add_switch(conn, system_id: int, member_ids: List[int]) -> Switch:
+    logger.debug("Adding switch (system={}, members={})".format(system_id, member_ids))
+    async with conn.transaction():
+        row = await conn.fetchrow("insert into switches (system) values ($1) returning *", system_id)
+
+        # Insert in list order, so switch member IDs (which determine fronter order) follow it too
+        await conn.execute("""insert into switch_members (switch, member)
+            select $1, member from unnest($2::int[]) with ordinality as m(member, position)
+            order by position""", row["id"], member_ids)
+        await conn.execute("update systems set current_switch = $1 where id = $2", row["id"], system_id)
+        await notify_invalidate(conn, "switch", system_id)
+    return Switch(**row, members=member_ids)
+
+@db_wrap
+async def move_switch(conn, system_id: int, switch_id: int, new_time: datetime):
+    logger.debug("Moving latest switch (system={}, id={}, new_time={})".format(system_id, switch_id, new_time))
+    async with conn.transaction():
+        await conn.execute("update switches set timestamp = $1 where system = $2 and id = $3", new_time, system_id, switch_id)
+        await update_current_switch(conn, system_id)
+        await notify_invalidate(conn, "switch", system_id)
 
 @db_wrap
 async def delete_switch(conn, switch_id: int):
     logger.debug("Deleting switch (id={})".format(switch_id))
-    await conn.execute("delete from switches where id = $1", switch_id)
+    async with conn.transaction():
+        system_id = await conn.fetchval("delete from switches where id = $1 returning system", switch_id)
+        if system_id:
+            await update_current_switch(conn, system_id)
+            await notify_invalidate(conn, "switch", system_id)
 
 @db_wrap
 async def get_server_info(conn, server_id: int):
@@ -308,6 +925,7 @@ async def update_server(conn, server_id: int, logging_channel_id: int):
     logging_channel_id = logging_channel_id if logging_channel_id else None
     logger.debug("Updating server settings (id={}, log_channel={})".format(server_id, logging_channel_id))
     await conn.execute("insert into servers (id, log_channel) values ($1, $2) on conflict (id) do update set log_channel = $2", server_id, logging_channel_id)
+    await notify_invalidate(conn, "server", server_id)
 
 @db_wrap
 async def member_count(conn) -> int:
@@ -319,13 +937,166 @@ async def system_count(conn) -> int:
 
 @db_wrap
 async def message_count(conn) -> int:
-    return await conn.fetchval("select count(*) from messages")
+    # Summing the per-member counters is far cheaper than counting the messages table itself
+    return await conn.fetchval("select coalesce(sum(message_count), 0) from member_stats")
 
 @db_wrap
 async def account_count(conn) -> int:
     return await conn.fetchval("select count(*) from accounts")
 
+@db_wrap
+async def estimate_table_sizes(conn, tables: List[str]) -> Dict[str, int]:
+    """Returns the planner's row count estimates for the given tables. Partitioned tables get the sum of their partitions."""
+    rows = await conn.fetch("""select
+        parent.relname as name,
+        coalesce(sum(greatest(child.reltuples, 0)), greatest(parent.reltuples, 0))::bigint as estimate
+    from
+        pg_class parent
+        left join pg_inherits on pg_inherits.inhparent = parent.oid
+        left join pg_class child on child.oid = pg_inherits.inhrelid
+    where
+        parent.relname = any($1)
+        and parent.relnamespace = 'public'::regnamespace
+    group by parent.relname, parent.reltuples""", tables)
+    return {row["name"]: row["estimate"] for row in rows}
+
+class MessagePartition(namedtuple("MessagePartition", ["name", "lower", "upper"])):
+    name: str
+    # Message ID bounds of the partition, None meaning unbounded
+    lower: Optional[int]
+    upper: Optional[int]
+
+
+def message_partition_name(month: datetime) -> str:
+    return "messages_y{:04d}m{:02d}".format(month.year, month.month)
+
+
+def next_month(month: datetime) -> datetime:
+    return month.replace(year=month.year + 1, month=1) if month.month == 12 else month.replace(month=month.month + 1)
+
+
+async def get_message_partitions(conn) -> List[MessagePartition]:
+    rows = await conn.fetch("""select
+        child.relname as name, pg_get_expr(child.relpartbound, child.oid) as bound
+    from
+        pg_inherits, pg_class child
+    where
+        pg_inherits.inhparent = to_regclass('messages')
+        and pg_inherits.inhrelid = child.oid""")
+
+    partitions = []
+    for row in rows:
+        # Bound expressions look like "FOR VALUES FROM ('123') TO (MAXVALUE)"
+        match = re.search(r"FROM \('?(\w+)'?\) TO \('?(\w+)'?\)", row["bound"])
+        if not match:
+            continue
+        lower, upper = [int(value) if value.isdigit() else None for value in match.groups()]
+        partitions.append(MessagePartition(name=row["name"], lower=lower, upper=upper))
+    return sorted(partitions, key=lambda p: p.lower or 0)
+
+
+async def ensure_message_partitions(conn, months_ahead: int = 2):
+    """Creates monthly message partitions from the end of the last existing one up to `months_ahead` months from now."""
+    partitions = await get_message_partitions(conn)
+    now = datetime.utcnow()
+    month = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+    covered_until = max([p.upper for p in partitions if p.upper is not None], default=0)
+
+    target = now + timedelta(days=31 * months_ahead)
+    while month <= target:
+        lower, upper = snowflake_from_time(month), snowflake_from_time(next_month(month))
+
+        # Only create the parts of the month not already covered by existing partitions
+        if upper > covered_until:
+            logger.info("Creating message partition {}".format(message_partition_name(month)))
+            await conn.execute("create table if not exists {} partition of messages for values from ({}) to ({})".format(
+                message_partition_name(month), max(lower, covered_until), upper))
+        month = next_month(month)
+
+
+async def archive_message_partitions(conn, horizon: datetime, archive_dir: str) -> List[str]:
+    """
+    Detaches every message partition lying entirely before `horizon`, writes its contents to a gzipped CSV file
+    in `archive_dir` and drops it. Returns the paths of the written archives.
+    """
+    horizon_mid = snowflake_from_time(horizon)
+    os.makedirs(archive_dir, exist_ok=True)
+
+    archived = []
+    for partition in await get_message_partitions(conn):
+        if partition.upper is None or partition.upper > horizon_mid:
+            continue
+
+        # Write to a temporary file first so a crash never leaves a partial archive looking complete
+        path = os.path.join(archive_dir, "{}.csv.gz".format(partition.name))
+        with gzip.open(path + ".tmp", "wb") as f:
+            await conn.copy_from_table(partition.name, output=f, format="csv", header=True)
+        os.replace(path + ".tmp", path)
+
+        async with conn.transaction():
+            await conn.execute("alter table messages detach partition {}".format(partition.name))
+            await conn.execute("drop table {}".format(partition.name))
+
+        logger.info("Archived message partition {} to {}".format(partition.name, path))
+        archived.append(path)
+    return archived
+
+
+async def run_message_retention(conn, archive_dir: str):
+    """Makes sure upcoming message partitions exist and archives expired ones. Safe to run from several processes at once."""
+    # Arbitrary but fixed lock key, so only one process does partition maintenance at a time
+    if not await conn.fetchval("select pg_try_advisory_lock(2939026)"):
+        return
+    try:
+        await ensure_message_partitions(conn)
+
+        horizon = message_horizon()
+        if horizon:
+            await archive_message_partitions(conn, horizon, archive_dir)
+    finally:
+        await conn.execute("select pg_advisory_unlock(2939026)")
+
+
+async def migrate_messages_to_partitioned(conn):
+    """
+    Converts a plain (pre-partitioning) messages table into a partitioned one.
+
+    The old table is kept as-is and attached as a single partition covering everything up to the start of next month,
+    so no rows have to be moved. It gets archived as a whole once all of it is past the retention horizon.
+    """
+    next_month_start = next_month(datetime.utcnow().replace(day=1, hour=0, minute=0, second=0, microsecond=0))
+
+    logger.info("Migrating messages table to a partitioned table")
+    async with conn.transaction():
+        await conn.execute("alter table messages rename to messages_legacy")
+        await conn.execute("alter table messages_legacy rename constraint messages_pkey to messages_legacy_pkey")
+        await create_messages_table(conn)
+        await conn.execute("alter table messages attach partition messages_legacy for values from (minvalue) to ({})".format(
+            snowflake_from_time(next_month_start)))
+
+
+async def create_messages_table(conn):
+    # Partitioned by message ID, which (being a snowflake) is effectively partitioning by time
+    await conn.execute("""create table if not exists messages (
+        mid         bigint primary key,
+        channel     bigint not null,
+        member      integer not null references members(id) on delete cascade,
+        sender      bigint not null
+    ) partition by range (mid)""")
+
+
 async def create_tables(conn):
+    """Creates and migrates the schema. Processes starting together (eg. shard workers) take turns doing so."""
+    # Blocking lock this time, as nobody should go on before the schema is up to date
+    await conn.execute("select pg_advisory_lock(2939032)")
+    try:
+        await migrate_tables(conn)
+    finally:
+        await conn.execute("select pg_advisory_unlock(2939032)")
+
+
+async def migrate_tables(conn):
     await conn.execute("""create table if not exists systems (
         id          serial primary key,
         hid         char(5) unique not null,
@@ -333,10 +1104,19 @@ async def create_tables(conn):
         description text,
         tag         text,
         avatar_url  text,
-        token       text,
+        token_hash  text,
         created     timestamp not null default (current_timestamp at time zone 'utc'),
         ui_tz       text not null default 'UTC'
     )""")
+
+    # API tokens used to be stored in plain text, hash them and get rid of the originals
+    await conn.execute("alter table systems add column if not exists token_hash text")
+    if await conn.fetchval("select exists (select 1 from information_schema.columns where table_name = 'systems' and column_name = 'token')"):
+        async with conn.transaction():
+            await conn.execute("update systems set token_hash = encode(sha256(convert_to(token, 'UTF8')), 'hex') where token is not null")
+            await conn.execute("alter table systems drop column token")
+    await conn.execute("create unique index if not exists systems_token_hash_idx on systems (token_hash)")
+
     await conn.execute("""create table if not exists members (
         id          serial primary key,
         hid         char(5) unique not null,
@@ -355,12 +1135,25 @@ async def create_tables(conn):
         uid         bigint primary key,
         system      serial not null references systems(id) on delete cascade
     )""")
-    await conn.execute("""create table if not exists messages (
-        mid         bigint primary key,
-        channel     bigint not null,
-        member      serial not null references members(id) on delete cascade,
-        sender      bigint not null
-    )""")
+    messages_partitioned = await conn.fetchval("select exists (select 1 from pg_partitioned_table where partrelid = to_regclass('messages'))")
+    if await conn.fetchval("select to_regclass('messages') is null"):
+        await create_messages_table(conn)
+    elif not messages_partitioned:
+        await migrate_messages_to_partitioned(conn)
+    await ensure_message_partitions(conn)
+
+    # Per-member message counters, kept in step by add_message/delete_message
+    # Counts are lifetime totals, so they don't go down when old messages are archived
+    if await conn.fetchval("select to_regclass('member_stats') is null"):
+        async with conn.transaction():
+            await conn.execute("""create table member_stats (
+                member          integer primary key references members(id) on delete cascade,
+                message_count   bigint not null default 0
+            )""")
+
+            logger.info("Backfilling member message counts")
+            await conn.execute("insert into member_stats (member, message_count) select member, count(*) from messages group by member")
+
     await conn.execute("""create table if not exists switches (
         id          serial primary key,
         system      serial not null references systems(id) on delete cascade,
@@ -371,6 +1164,52 @@ async def create_tables(conn):
         switch      serial not null references switches(id) on delete cascade,
         member      serial not null references members(id) on delete cascade
     )""")
+    # Last-changed timestamps, used as versions for HTTP caching in the API
+    await conn.execute("alter table systems add column if not exists updated timestamp not null default (current_timestamp at time zone 'utc')")
+    await conn.execute("alter table members add column if not exists updated timestamp not null default (current_timestamp at time zone 'utc')")
+
+    await conn.execute("create index if not exists switch_members_switch_idx on switch_members (switch)")
+    await conn.execute("create index if not exists switches_system_timestamp_idx on switches (system, timestamp)")
+    # Also covers exact name lookups (get_member_by_name) and alphabetical member lists
+    await conn.execute("create index if not exists members_system_name_idx on members (system, lower(name))")
+    # Superseded by the above
+    await conn.execute("drop index if exists members_system_idx")
+
+    # Trigram index for fuzzy member search (search_members). Creating the extension needs the right privileges,
+    # so without them search is just slower (or unavailable, on servers without pg_trgm)
+    try:
+        await conn.execute("create extension if not exists pg_trgm")
+        await conn.execute("create index if not exists members_name_trgm_idx on members using gin (lower(name) gin_trgm_ops)")
+    except asyncpg.exceptions.PostgresError:
+        logger.warning("Could not set up pg_trgm, fuzzy member search won't be indexed", exc_info=True)
+    await detect_extensions(conn)
+
+    # Seconds each member fronted per system per UTC day, see refresh_front_rollup
+    # A null member means time with no fronter
+    await conn.execute("""create table if not exists front_daily (
+        system      integer not null references systems(id) on delete cascade,
+        member      integer references members(id) on delete set null,
+        day         date not null,
+        seconds     double precision not null
+    )""")
+    await conn.execute("create index if not exists front_daily_system_day_idx on front_daily (system, day)")
+    if await conn.fetchval("select to_regclass('front_daily_system_member_day_idx') is null"):
+        async with conn.transaction():
+            # Concurrent refreshes used to be able to leave duplicate rows behind - rather than picking through them,
+            # start over, and let backfill_front_rollup rebuild everything (front percentages use raw switches meanwhile)
+            await conn.execute("truncate front_daily")
+            await conn.execute("alter table front_daily drop constraint if exists front_daily_member_fkey")
+            await conn.execute("alter table front_daily add constraint front_daily_member_fkey foreign key (member) references members(id) on delete set null")
+            # Rows without a member (no fronter, or deleted members) aren't covered, but those are only summed anyway
+            await conn.execute("create unique index front_daily_system_member_day_idx on front_daily (system, member, day)")
+
+    # Denormalized pointer to each system's latest switch, so current fronter lookups don't have to sort switches
+    if not await conn.fetchval("select exists (select 1 from information_schema.columns where table_name = 'systems' and column_name = 'current_switch')"):
+        async with conn.transaction():
+            await conn.execute("alter table systems add column current_switch integer references switches(id) on delete set null")
+            await conn.execute("""update systems set current_switch = (
+                select id from switches where switches.system = systems.id order by timestamp desc limit 1
+            )""")
     await conn.execute("""create table if not exists webhooks (
         channel     bigint primary key,
         webhook     bigint not null,
@@ -380,3 +1219,9 @@ async def create_tables(conn):
         id          bigint primary key,
         log_channel bigint
     )""")
+
+    # Unused HIDs waiting to be handed out, see ALLOCATE_HID_QUERY
+    await conn.execute("""create table if not exists hid_pool (
+        hid         char(5) primary key
+    )""")
+    await refill_hid_pool(conn)
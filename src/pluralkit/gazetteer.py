@@ -0,0 +1,228 @@
+"""
+Offline city lookups for setting a system's time zone.
+
+The gazetteer is a text file of cities, one per line as `key<TAB>name<TAB>country<TAB>population<TAB>time zone`,
+sorted by key (the normalized city name). It's memory-mapped and binary searched, so lookups only touch the few pages
+around the matching lines and the file is shared between processes through the page cache.
+
+Build one from a GeoNames city dump (eg. https://download.geonames.org/export/dump/cities15000.zip) with:
+
+    python -m pluralkit.gazetteer cities15000.txt gazetteer.txt
+
+Cities that aren't in the gazetteer are looked up on OpenStreetMap through Nominatim instead.
+"""
+import difflib
+import logging
+import mmap
+import os
+import sys
+import unicodedata
+from collections import namedtuple
+from typing import Iterator, List, Optional, Tuple
+
+import aiohttp
+
+from pluralkit.cache import TTLCache
+
+logger = logging.getLogger("pluralkit.gazetteer")
+
+NOMINATIM_URL = "https://nominatim.openstreetmap.org/search"
+NOMINATIM_CACHE_TTL = 24 * 60 * 60
+NOMINATIM_NOT_FOUND_TTL = 60 * 60
+
+# Prefix matches need to cover at least this much of the name (unless they end on a word boundary), fuzzy matches need
+# at least this similarity. Anything less sure than that goes to Nominatim, since the gazetteer only has larger cities
+# and a wrong guess sets a wrong time zone.
+PREFIX_MIN_COVERAGE = 0.8
+FUZZY_CUTOFF = 0.85
+
+
+class City(namedtuple("City", ["name", "country", "population", "timezone"])):
+    name: str
+    country: str
+    population: int
+    timezone: str
+
+    @property
+    def display_name(self) -> str:
+        return "{}, {}".format(self.name, self.country) if self.country else self.name
+
+
+def normalize(name: Optional[str]) -> str:
+    """Lowercases a city name and strips accents and punctuation, so eg. "São Paulo" and "sao paulo" match."""
+    decomposed = unicodedata.normalize("NFKD", name or "")
+    stripped = "".join(c if c.isalnum() else " " for c in decomposed if not unicodedata.combining(c))
+    return " ".join(stripped.lower().split())
+
+
+class Gazetteer:
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def _line_start(self, pos: int) -> int:
+        return self._map.rfind(b"\n", 0, pos) + 1
+
+    def _key_at(self, start: int) -> bytes:
+        return self._map[start:self._map.find(b"\t", start)]
+
+    def _lower_bound(self, key: bytes) -> int:
+        """Returns the offset of the first line with a key not less than the given one."""
+        lo, hi = 0, len(self._map)
+        while lo < hi:
+            mid = self._line_start((lo + hi) // 2)
+            end = self._map.find(b"\n", mid) + 1
+            if self._key_at(mid) < key:
+                lo = end
+            else:
+                hi = mid
+        return lo
+
+    def _lines_from(self, start: int) -> Iterator[Tuple[str, City]]:
+        size = len(self._map)
+        while start < size:
+            end = self._map.find(b"\n", start)
+            key, name, country, population, timezone = self._map[start:end].decode("utf-8").split("\t")
+            yield key, City(name, country, int(population), timezone)
+            start = end + 1
+
+    def _with_prefix(self, prefix: str) -> Iterator[Tuple[str, City]]:
+        for key, city in self._lines_from(self._lower_bound(prefix.encode("utf-8"))):
+            if not key.startswith(prefix):
+                break
+            yield key, city
+
+    def find(self, query: str) -> Optional[City]:
+        """
+        Finds the city with the given name, the most populous one if there are several.
+
+        Failing that, a name that starts with the query or is spelled almost the same is also accepted, but only if
+        there's exactly one such name and it's a close enough match. Returns None if nothing is certain enough.
+        """
+        key = normalize(query)
+        if not key:
+            return None
+
+        # Most populous city per name starting with the query
+        prefixed = {}
+        for city_key, city in self._with_prefix(key):
+            if city_key not in prefixed or prefixed[city_key].population < city.population:
+                prefixed[city_key] = city
+
+        if key in prefixed:
+            return prefixed[key]
+
+        if len(prefixed) == 1:
+            city_key, city = prefixed.popitem()
+            if city_key[len(key)] == " " or len(key) / len(city_key) >= PREFIX_MIN_COVERAGE:
+                return city
+
+        candidates = {}
+        for city_key, city in self._with_prefix(key[0]):
+            if city_key not in candidates or candidates[city_key].population < city.population:
+                candidates[city_key] = city
+        matches = difflib.get_close_matches(key, candidates.keys(), n=2, cutoff=FUZZY_CUTOFF)
+        if len(matches) == 1:
+            return candidates[matches[0]]
+        return None
+
+
+_gazetteer = None
+_gazetteer_loaded = False
+
+
+def get_gazetteer() -> Optional[Gazetteer]:
+    """Opens the gazetteer at GAZETTEER_FILE on first use. Returns None if there isn't one."""
+    global _gazetteer, _gazetteer_loaded
+    if not _gazetteer_loaded:
+        _gazetteer_loaded = True
+        path = os.environ.get("GAZETTEER_FILE")
+        if path:
+            try:
+                _gazetteer = Gazetteer(path)
+            except (OSError, ValueError):
+                logger.exception("Error opening gazetteer {}, falling back to Nominatim".format(path))
+    return _gazetteer
+
+
+_session = None
+_timezone_finder = None
+nominatim_cache = TTLCache(ttl=NOMINATIM_CACHE_TTL, max_size=10000)
+
+
+def get_session() -> aiohttp.ClientSession:
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession()
+    return _session
+
+
+def timezone_at(lat: float, lng: float) -> Optional[str]:
+    # Loading timezonefinder's data takes a while, so it only happens once something isn't in the gazetteer
+    global _timezone_finder
+    if _timezone_finder is None:
+        import timezonefinder
+        _timezone_finder = timezonefinder.TimezoneFinder()
+    return _timezone_finder.timezone_at(lng=lng, lat=lat)
+
+
+async def find_city_nominatim(query: str) -> Optional[City]:
+    """
+    Looks up a city on OpenStreetMap through Nominatim, and its time zone through timezonefinder.
+
+    :raises: aiohttp.ClientError if Nominatim couldn't be reached or returned an error
+    """
+    cache_key = normalize(query)
+    missing = object()
+    city = nominatim_cache.get(cache_key, missing)
+    if city is not missing:
+        return city
+
+    async with get_session().get(NOMINATIM_URL, params={"city": query, "format": "json", "limit": "1"}) as r:
+        r.raise_for_status()
+        data = await r.json()
+
+    city = None
+    if data:
+        lat, lng = float(data[0]["lat"]), float(data[0]["lon"])
+        # Imported here since pluralkit.utils imports the database module, which `python -m pluralkit.gazetteer` doesn't need
+        from pluralkit.utils import workers
+        timezone = await workers.run(timezone_at, lat, lng, cpu_bound=True)
+        if timezone:
+            city = City(data[0]["display_name"], "", 0, timezone)
+
+    nominatim_cache.set(cache_key, city, ttl=NOMINATIM_CACHE_TTL if city else NOMINATIM_NOT_FOUND_TTL)
+    return city
+
+
+def build(source_path: str, target_path: str):
+    """Converts a GeoNames city dump (tab separated, see the GeoNames readme) into a sorted gazetteer file."""
+    lines: List[Tuple[str, int, str]] = []
+    with open(source_path, encoding="utf-8") as f:
+        for row in f:
+            fields = row.rstrip("\n").split("\t")
+            name, ascii_name, country, population, timezone = fields[1], fields[2], fields[8], fields[14], fields[17]
+            if not timezone:
+                continue
+
+            for key in {normalize(name), normalize(ascii_name)}:
+                if key:
+                    lines.append((key, -int(population or 0), "\t".join([key, name, country, population or "0", timezone])))
+
+    lines.sort()
+    with open(target_path, "w", encoding="utf-8") as f:
+        for _, _, line in lines:
+            f.write(line + "\n")
+    print("Wrote {} entries to {}".format(len(lines), target_path))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python -m pluralkit.gazetteer <GeoNames cities file> <output file>", file=sys.stderr)
+        sys.exit(1)
+    build(sys.argv[1], sys.argv[2])
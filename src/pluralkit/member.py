@@ -2,7 +2,7 @@ import re
 from datetime import date, datetime
 
 from collections.__init__ import namedtuple
-from typing import Optional, Union
+from typing import List, Optional, Tuple, Union
 
 from pluralkit import db, errors
 from pluralkit.utils import validate_avatar_url_or_raise, contains_custom_emoji
@@ -10,7 +10,7 @@ from pluralkit.utils import validate_avatar_url_or_raise, contains_custom_emoji
 
 class Member(namedtuple("Member",
                         ["id", "hid", "system", "color", "avatar_url", "name", "birthday", "pronouns", "description",
-                         "prefix", "suffix", "created"])):
+                         "prefix", "suffix", "created", "updated"])):
     """An immutable representation of a system member fetched from the database."""
     id: int
     hid: str
@@ -24,6 +24,7 @@ class Member(namedtuple("Member",
     prefix: str
     suffix: str
     created: datetime
+    updated: datetime
 
     def to_json(self):
         return {
@@ -63,6 +64,11 @@ class Member(namedtuple("Member",
         by_name = await Member.get_member_by_name(conn, system_id, name)
         return by_name
 
+    @staticmethod
+    async def search(conn, system_id: int, query: str, limit: int = 10) -> "List[Tuple[Member, float]]":
+        """Returns up to `limit` members of the given system with names similar to the query, and their similarity scores (0 to 1), best first."""
+        return await db.search_members(conn, system_id, query, limit) or []
+
 
     async def set_name(self, conn, new_name: str):
         """
@@ -154,11 +160,22 @@ class Member(namedtuple("Member",
 
     async def delete(self, conn):
         """Delete this member from the database."""
-        await db.delete_member(conn, self.id)
+        async with conn.transaction():
+            first_switch_time = await db.get_first_switch_timestamp_with_member(conn, self.id)
+            await db.delete_member(conn, self.id)
+
+            # Switches the member was in lose them (or become switches with no fronter), same as front_breakdown sees it
+            if first_switch_time:
+                await db.refresh_front_rollup(conn, self.system, first_switch_time)
 
     async def fetch_system(self, conn) -> "System":
         """Fetch the member's system from the database"""
         return await db.get_system(conn, self.system)
 
     async def message_count(self, conn) -> int:
-        return await db.get_member_message_count(conn, self.id)
\ No newline at end of file
+        """Returns the number of messages proxied through this member. Reads a maintained counter, so this is cheap."""
+        return await db.get_member_message_count(conn, self.id)
+
+    async def fetch_system_and_message_count(self, conn) -> "Tuple[System, int]":
+        """Fetches the member's system along with the member's message count, in a single query"""
+        return await db.get_member_system_and_message_count(conn, self.id)
\ No newline at end of file
@@ -0,0 +1,69 @@
+import asyncio
+import logging
+import time
+from datetime import datetime
+
+from pluralkit import db
+
+logger = logging.getLogger("pluralkit.stats")
+
+
+class StatsCache:
+    """
+    Keeps global object counts in memory so they can be served without querying the database.
+
+    Counts are refreshed every `interval` seconds from the planner's row estimates, and recounted exactly
+    every `exact_interval` seconds. The first refresh is always exact.
+    """
+
+    def __init__(self, pool, interval: float = 60, exact_interval: float = 60 * 60):
+        self.pool = pool
+        self.interval = interval
+        self.exact_interval = exact_interval
+
+        self.systems = 0
+        self.members = 0
+        self.accounts = 0
+        self.messages = 0
+        self.generated_at = None
+        self.last_exact = None
+
+    async def refresh(self, exact: bool = False):
+        async with self.pool.acquire() as conn:
+            if exact:
+                self.systems = await db.system_count(conn)
+                self.members = await db.member_count(conn)
+                self.accounts = await db.account_count(conn)
+                self.last_exact = time.monotonic()
+            else:
+                # Tables that haven't been analyzed yet have no estimate (0, or -1 on newer Postgres versions),
+                # so those keep their last known count instead
+                estimates = await db.estimate_table_sizes(conn, ["systems", "members", "accounts"]) or {}
+                self.systems = estimates.get("systems") or self.systems
+                self.members = estimates.get("members") or self.members
+                self.accounts = estimates.get("accounts") or self.accounts
+
+            # Already backed by maintained counters, so this is cheap enough to do exactly every time
+            self.messages = await db.message_count(conn)
+        self.generated_at = datetime.utcnow()
+
+    async def run(self):
+        # Whoever started this may have just refreshed already (eg. to have stats ready before serving requests)
+        if self.generated_at:
+            await asyncio.sleep(self.interval)
+
+        while True:
+            exact = self.last_exact is None or time.monotonic() - self.last_exact >= self.exact_interval
+            try:
+                await self.refresh(exact)
+            except Exception:
+                logger.exception("Error while refreshing stats")
+            await asyncio.sleep(self.interval)
+
+    def to_json(self):
+        return {
+            "systems": self.systems,
+            "members": self.members,
+            "messages": self.messages,
+            "generated_at": self.generated_at.isoformat() if self.generated_at else None
+        }
@@ -13,13 +13,30 @@ class Switch(namedtuple("Switch", ["id", "system", "timestamp", "members"])):
     members: List[int]
 
     async def fetch_members(self, conn) -> List[Member]:
-        return await db.get_members(conn, self.members)
+        # Collect in dict and then look up as list, to preserve fronter order
+        members = {member.id: member for member in await db.get_members(conn, self.members)}
+        return [members[member_id] for member_id in self.members if member_id in members]
 
     async def delete(self, conn):
-        await db.delete_switch(conn, self.id)
+        event = db.SwitchEvent(type="deleted", system=self.system, switch=self.id)
+        async with conn.transaction():
+            await db.delete_switch(conn, self.id)
+
+            # The switch before this one (if it was the latest, now the current one) gets its time back, and it may
+            # have started days earlier
+            latest_switch = await db.get_current_switch(conn, self.system)
+            since = min(self.timestamp, latest_switch.timestamp) if latest_switch else self.timestamp
+            await db.refresh_front_rollup(conn, self.system, since)
+            await db.notify_switch_event(conn, event)
 
     async def move(self, conn, new_timestamp):
-        await db.move_switch(conn, self.system, self.id, new_timestamp)
+        event = db.SwitchEvent(type="moved", system=self.system, switch=self.id)
+        async with conn.transaction():
+            await db.move_switch(conn, self.system, self.id, new_timestamp)
+
+            # Front time only changes from whichever of the two times is earliest onward
+            await db.refresh_front_rollup(conn, self.system, min(self.timestamp, new_timestamp))
+            await db.notify_switch_event(conn, event)
 
     async def to_json(self, conn):
         return {
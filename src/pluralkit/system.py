@@ -10,22 +10,27 @@ import pytz
 from pluralkit import db, errors
 from pluralkit.member import Member
 from pluralkit.switch import Switch
-from pluralkit.utils import generate_hid, contains_custom_emoji, validate_avatar_url_or_raise
+from pluralkit.utils import contains_custom_emoji, hash_token, validate_avatar_url_or_raise
 
 class TupperboxImportResult(namedtuple("TupperboxImportResult", ["updated", "created", "tags"])):
     pass
 
-class System(namedtuple("System", ["id", "hid", "name", "description", "tag", "avatar_url", "token", "created", "ui_tz"])):
+class System(namedtuple("System", ["id", "hid", "name", "description", "tag", "avatar_url", "token_hash", "created", "ui_tz", "current_switch", "updated"])):
     id: int
     hid: str
     name: str
     description: str
     tag: str
     avatar_url: str
-    token: str
+    # SHA-256 of the API token (see utils.hash_token), the token itself is never stored
+    token_hash: str
     created: datetime
     # pytz-compatible time zone name, usually Olson-style (eg. Europe/Amsterdam)
     ui_tz: str
+    # ID of the latest switch logged, kept up to date by the switch-modifying queries
+    current_switch: Optional[int]
+    # Last time the system or any of its members changed
+    updated: datetime
 
     @staticmethod
     async def get_by_id(conn, system_id: int) -> Optional["System"]:
@@ -46,10 +51,8 @@ class System(namedtuple("System", ["id", "hid", "name", "description", "tag", "a
             if existing_system:
                 raise errors.ExistingSystemError()
 
-            new_hid = generate_hid()
-
             async with conn.transaction():
-                new_system = await db.create_system(conn, system_name, new_hid)
+                new_system = await db.create_system(conn, system_name)
                 await db.link_account(conn, new_system.id, account_id)
 
             return new_system
@@ -108,34 +111,40 @@ class System(namedtuple("System", ["id", "hid", "name", "description", "tag", "a
         await db.remove_system(conn, self.id)
 
     async def refresh_token(self, conn) -> str:
-        new_token = "".join(random.choices(string.ascii_letters + string.digits, k=64))
-        await db.update_system_field(conn, self.id, "token", new_token)
+        """Generates a new API token for the system, invalidating the previous one. Returns the new (plain text) token."""
+        new_token = "".join(random.SystemRandom().choices(string.ascii_letters + string.digits, k=64))
+        await db.update_system_field(conn, self.id, "token_hash", hash_token(new_token))
         return new_token
 
-    async def create_member(self, conn, member_name: str) -> Member:
-        # TODO: figure out what to do if this errors out on collision on generate_hid
-        new_hid = generate_hid()
-
+    async def create_member(self, conn, member_name: str, member_hid: Optional[str] = None) -> Member:
+        """Creates a member in this system, with a fresh HID from the pool unless given one reserved with db.reserve_hids."""
         if len(member_name) > self.get_member_name_limit():
             raise errors.MemberNameTooLongError(tag_present=bool(self.tag))
 
-        member = await db.create_member(conn, self.id, member_name, new_hid)
+        member = await db.create_member(conn, self.id, member_name, member_hid)
         return member
 
     async def get_members(self, conn) -> List[Member]:
         return await db.get_all_members(conn, self.id)
 
+    async def get_members_page(self, conn, limit: int, offset: int) -> List[Member]:
+        """Returns a page of this system's members, in alphabetical order."""
+        return await db.get_members_page(conn, self.id, limit, offset)
+
+    async def get_member_count(self, conn) -> int:
+        return await db.get_member_count(conn, self.id)
+
     async def get_switches(self, conn, count) -> List[Switch]:
         """Returns the latest `count` switches logged for this system, ordered latest to earliest."""
         return [Switch(**s) for s in await db.front_history(conn, self.id, count)]
 
+    async def get_switches_with_members(self, conn, count) -> List[Tuple[Switch, List[Member]]]:
+        """Returns the latest `count` switches logged for this system along with their members, ordered latest to earliest."""
+        return await db.front_history_with_members(conn, self.id, count)
+
     async def get_latest_switch(self, conn) -> Optional[Switch]:
         """Returns the latest switch logged for this system, or None if no switches have been logged"""
-        switches = await self.get_switches(conn, 1)
-        if switches:
-            return switches[0]
-        else:
-            return None
+        return await db.get_current_switch(conn, self.id)
 
     async def add_switch(self, conn, members: List[Member]) -> Switch:
         """
@@ -148,26 +157,25 @@ class System(namedtuple("System", ["id", "hid", "name", "description", "tag", "a
         last_switch = await self.get_latest_switch(conn)
 
         # If we have a switch logged before, make sure this isn't a dupe switch
-        if last_switch:
-            last_switch_members = await last_switch.fetch_members(conn)
-            last_ids = [member.id for member in last_switch_members]
-
-            # We don't compare by set() here because swapping multiple is a valid operation
-            if last_ids == new_ids:
-                raise errors.MembersAlreadyFrontingError(members)
+        # We don't compare by set() here because swapping multiple is a valid operation
+        if last_switch and last_switch.members == new_ids:
+            raise errors.MembersAlreadyFrontingError(members)
 
         # Check for dupes
         if len(set(new_ids)) != len(new_ids):
             raise errors.DuplicateSwitchMembersError()
 
         async with conn.transaction():
-            switch_id = await db.add_switch(conn, self.id)
+            switch = await db.add_switch(conn, self.id, new_ids)
+
+            # The previous switch has now ended, so it counts towards the daily rollup
+            if last_switch:
+                await db.refresh_front_rollup(conn, self.id, last_switch.timestamp)
 
-            # TODO: batch query here
-            for member in members:
-                await db.add_switch_member(conn, switch_id, member.id)
+            event = db.SwitchEvent(type="added", system=self.id, switch=switch.id)
+            await db.notify_switch_event(conn, event)
 
-            return await self.get_latest_switch(conn)
+        return switch
 
     def get_member_name_limit(self) -> int:
         """Returns the maximum length a member's name or nickname is allowed to be in order for the member to be proxied. Depends on the system tag."""
@@ -248,22 +256,31 @@ class System(namedtuple("System", ["id", "hid", "name", "description", "tag", "a
         if not isinstance(data["tuppers"], list):
             raise errors.TupperboxImportError()
         
-        all_tags = set()
-        created_members = set()
-        updated_members = set()
         for tupper in data["tuppers"]:
             # Sanity check tupper fields
             for field in ["name", "avatar_url", "brackets", "birthday", "description", "tag"]:
                 if field not in tupper:
                     raise errors.TupperboxImportError()
-            
+            if not (isinstance(tupper["brackets"], list) and len(tupper["brackets"]) >= 2):
+                raise errors.TupperboxImportError()
+
+        # Reserve HIDs for all members we'll have to create up front, rather than taking them one by one
+        members_by_name = {member.name.lower(): member for member in await self.get_members(conn)}
+        new_names = {str(tupper["name"]).lower() for tupper in data["tuppers"]} - set(members_by_name.keys())
+        new_hids = await db.reserve_hids(conn, len(new_names)) if new_names else []
+
+        all_tags = set()
+        created_members = set()
+        updated_members = set()
+        for tupper in data["tuppers"]:
             # Find member by name, create if not exists
             member_name = str(tupper["name"])
-            member = await Member.get_member_by_name(conn, self.id, member_name)
+            member = members_by_name.get(member_name.lower())
             if not member:
                 # And keep track of created members
                 created_members.add(member_name)
-                member = await self.create_member(conn, member_name)
+                member = await self.create_member(conn, member_name, new_hids.pop())
+                members_by_name[member_name.lower()] = member
             else:
                 # Keep track of updated members
                 updated_members.add(member_name)
@@ -272,8 +289,6 @@ class System(namedtuple("System", ["id", "hid", "name", "description", "tag", "a
             await member.set_avatar(conn, str(tupper["avatar_url"]))
 
             # Set proxy tags
-            if not (isinstance(tupper["brackets"], list) and len(tupper["brackets"]) >= 2):
-                raise errors.TupperboxImportError()
             await member.set_proxy_tags(conn, str(tupper["brackets"][0]), str(tupper["brackets"][1]))
 
             # Set birthdate (input is in ISO-8601, first 10 characters is the date)
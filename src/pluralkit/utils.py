@@ -1,16 +1,26 @@
+import asyncio
+import hashlib
 import humanize
+import logging
+import os
 import re
 
 import random
 import string
+import time
+from collections import namedtuple
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
-from typing import List, Tuple, Union
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 from urllib.parse import urlparse
 
 from pluralkit import db
 from pluralkit.errors import InvalidAvatarURLError
 
 
+logger = logging.getLogger("pluralkit.utils")
+
+
 def display_relative(time: Union[datetime, timedelta]) -> str:
     if isinstance(time, datetime):
         time = datetime.utcnow() - time
@@ -18,49 +28,198 @@ def display_relative(time: Union[datetime, timedelta]) -> str:
 
 
 async def get_fronter_ids(conn, system_id) -> (List[int], datetime):
-    switches = await db.front_history(conn, system_id=system_id, count=1)
-    if not switches:
+    switch = await db.get_current_switch(conn, system_id)
+    if not switch:
         return [], None
 
-    if not switches[0]["members"]:
-        return [], switches[0]["timestamp"]
-
-    return switches[0]["members"], switches[0]["timestamp"]
+    return switch.members, switch.timestamp
 
 
 async def get_fronters(conn, system_id) -> (List["Member"], datetime):
-    member_ids, timestamp = await get_fronter_ids(conn, system_id)
-
-    # Collect in dict and then look up as list, to preserve return order
-    members = {member.id: member for member in await db.get_members(conn, member_ids)}
-    return [members[member_id] for member_id in member_ids], timestamp
-
-
-async def get_front_history(conn, system_id, count) -> List[Tuple[datetime, List["pluMember"]]]:
-    # Get history from DB
-    switches = await db.front_history(conn, system_id=system_id, count=count)
-    if not switches:
-        return []
-
-    # Get all unique IDs referenced
-    all_member_ids = {id for switch in switches for id in switch["members"]}
-
-    # And look them up in the database into a dict
-    all_members = {member.id: member for member in await db.get_members(conn, list(all_member_ids))}
+    current = await db.get_current_switch_with_members(conn, system_id)
+    if not current:
+        return [], None
 
-    # Collect in array and return
-    out = []
-    for switch in switches:
-        timestamp = switch["timestamp"]
-        members = [all_members[id] for id in switch["members"]]
-        out.append((timestamp, members))
-    return out
+    switch, members = current
+    return members, switch.timestamp
+
+
+async def get_front_history(conn, system_id, count) -> List[Tuple[datetime, List["Member"]]]:
+    # Switches come back from the DB with their members already attached
+    switches = await db.front_history_with_members(conn, system_id=system_id, count=count)
+    return [(switch.timestamp, members) for switch, members in switches]
+
+
+class FrontBreakdown(namedtuple("FrontBreakdown", ["members", "span_start", "span_end"])):
+    # Members (None meaning no fronter) and how long they fronted, longest first
+    members: List[Tuple[Optional["Member"], timedelta]]
+    span_start: datetime
+    span_end: datetime
+
+    @property
+    def total_time(self) -> timedelta:
+        return self.span_end - self.span_start
+
+    def fraction(self, front_time: timedelta) -> float:
+        total = self.total_time.total_seconds()
+        return front_time.total_seconds() / total if total else 0.0
+
+    def to_json(self):
+        return {
+            "since": self.span_start.isoformat(),
+            "until": self.span_end.isoformat(),
+            "members": [{
+                "member": member.hid if member else None,
+                "name": member.name if member else None,
+                "seconds": front_time.total_seconds(),
+                "percent": self.fraction(front_time) * 100
+            } for member, front_time in self.members]
+        }
+
+
+# Ranges at least this long are summed from the daily rollup instead of raw switches
+ROLLUP_MIN_RANGE = timedelta(days=7)
+
+
+async def get_front_breakdown(conn, system_id, since: Optional[datetime]) -> Optional[FrontBreakdown]:
+    """Calculates how long each member fronted from `since` (or the first switch, if None) until now. Returns None if there are no switches."""
+    until = datetime.utcnow()
+    since = since or datetime.min
+
+    # Systems without rollup rows (not backfilled yet, or with a single switch) or without a current switch are
+    # summed up from the raw switches, same as short ranges
+    latest_switch = None
+    if until - since >= ROLLUP_MIN_RANGE:
+        latest_switch = await db.get_current_switch(conn, system_id)
+    if not latest_switch or not await db.has_front_rollup(conn, system_id):
+        members, span_start = await db.front_breakdown(conn, system_id, since, until)
+        if not span_start:
+            return None
+        return FrontBreakdown(members=members, span_start=span_start, span_end=until)
+
+    span_start = await db.get_front_span_start(conn, system_id, since)
+    if not span_start:
+        return None
+
+    # The rollup covers whole days of ended switches, so take everything before the first full day,
+    # and the part of the current switch after it, from the raw switches instead
+    first_day = datetime.combine(span_start.date(), datetime.min.time())
+    if first_day < span_start:
+        first_day += timedelta(days=1)
+
+    parts = [
+        (await db.front_breakdown(conn, system_id, span_start, first_day))[0],
+        await db.front_rollup_breakdown(conn, system_id, first_day.date()) or [],
+        (await db.front_breakdown(conn, system_id, max(first_day, latest_switch.timestamp), until))[0]
+    ]
+
+    # Add up the parts per member (None being no fronter)
+    totals = {}
+    members_by_id = {}
+    for part in parts:
+        for member, front_time in part:
+            member_id = member.id if member else None
+            totals[member_id] = totals.get(member_id, timedelta()) + front_time
+            members_by_id[member_id] = member
+
+    members = sorted([(members_by_id[member_id], front_time) for member_id, front_time in totals.items()], key=lambda x: x[1], reverse=True)
+    return FrontBreakdown(members=members, span_start=span_start, span_end=until)
+
+
+def hash_token(token: str) -> str:
+    """Hashes an API token for storage and lookup. Tokens are random and long, so a plain SHA-256 is enough."""
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
 
 
 def generate_hid() -> str:
     return "".join(random.choices(string.ascii_lowercase, k=5))
 
 
+class TaskTimings:
+    __slots__ = ["count", "wait_time", "run_time", "max_run_time"]
+
+    def __init__(self):
+        self.count = 0
+        self.wait_time = 0.0
+        self.run_time = 0.0
+        self.max_run_time = 0.0
+
+    def record(self, wait_time: float, run_time: float):
+        self.count += 1
+        self.wait_time += wait_time
+        self.run_time += run_time
+        self.max_run_time = max(self.max_run_time, run_time)
+
+
+def _timed_call(func: Callable, args: tuple, kwargs: dict) -> Tuple[Any, float]:
+    # Runs in the worker (thread or process), so the run time doesn't include waiting for the result to come back
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+class WorkerPool:
+    """
+    Runs blocking calls (parsing, serializing, ...) outside the event loop, so one slow call doesn't hold up every
+    other event on the shard.
+
+    Calls run on a pool of `threads` threads, except for `cpu_bound` ones, which go to a pool of `processes` processes
+    if there is one (their function, arguments and result must be picklable). At most as many calls as there are
+    workers run at a time, the rest wait their turn. How long calls wait and run is recorded per function, see `report`.
+    """
+
+    # Calls running longer than this are logged
+    SLOW_TASK_TIME = 1.0
+
+    def __init__(self, threads: int = 4, processes: int = 0):
+        self.threads = max(1, threads)
+        self.processes = max(0, processes)
+        self.timings: Dict[str, TaskTimings] = {}
+
+        # Both are created on first use, so importing this doesn't start any threads or processes
+        self._thread_pool = None
+        self._process_pool = None
+        self._thread_slots = None
+        self._process_slots = None
+
+    def _pool(self, cpu_bound: bool) -> Tuple[Executor, asyncio.Semaphore]:
+        if cpu_bound and self.processes:
+            if not self._process_pool:
+                self._process_pool = ProcessPoolExecutor(max_workers=self.processes)
+                self._process_slots = asyncio.Semaphore(self.processes)
+            return self._process_pool, self._process_slots
+
+        if not self._thread_pool:
+            self._thread_pool = ThreadPoolExecutor(max_workers=self.threads)
+            self._thread_slots = asyncio.Semaphore(self.threads)
+        return self._thread_pool, self._thread_slots
+
+    async def run(self, func: Callable, *args, cpu_bound: bool = False, **kwargs) -> Any:
+        """Calls `func(*args, **kwargs)` on a worker and returns its result (or raises its exception)."""
+        pool, slots = self._pool(cpu_bound)
+        name = "{}.{}".format(func.__module__, getattr(func, "__qualname__", func.__name__))
+
+        queued = time.perf_counter()
+        async with slots:
+            wait_time = time.perf_counter() - queued
+            result, run_time = await asyncio.get_event_loop().run_in_executor(pool, _timed_call, func, args, kwargs)
+
+        self.timings.setdefault(name, TaskTimings()).record(wait_time, run_time)
+        if run_time > self.SLOW_TASK_TIME:
+            logger.warning("Slow worker task {} took {:.2f} seconds".format(name, run_time))
+        return result
+
+    def report(self) -> str:
+        return ", ".join("{}: {} calls, {:.1f} ms avg ({:.1f} ms max), {:.1f} ms avg wait".format(
+            name, timings.count, timings.run_time / timings.count * 1000, timings.max_run_time * 1000,
+            timings.wait_time / timings.count * 1000) for name, timings in sorted(self.timings.items())) or "no calls"
+
+
+# Shared by everything in the process, see WorkerPool
+workers = WorkerPool(threads=int(os.environ.get("WORKER_THREADS") or 4),
+                     processes=int(os.environ.get("WORKER_PROCESSES") or 0))
+
+
 def contains_custom_emoji(value):
     return bool(re.search("<a?:\w+:\d+>", value))
 
@@ -0,0 +1,144 @@
+import asyncio
+import logging
+import os
+import signal
+import sys
+import tempfile
+import time
+from typing import List
+
+try:
+    # uvloop doesn't work on Windows, therefore an optional dependency
+    import uvloop
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:
+    pass
+
+# Runs the bot as several worker processes (each running bot_main.py with its own range of shards, its own database
+# pool and its own caches), restarting any that exit or stop sending heartbeats.
+logging.basicConfig(level=logging.INFO, format="[%(asctime)s] [%(name)s] [%(levelname)s] %(message)s")
+logger = logging.getLogger("pluralkit.shards")
+
+BOT_MAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot_main.py")
+
+# Discord only lets a bot identify once every 5 seconds, so workers are started one after another
+IDENTIFY_INTERVAL = 5
+
+# Workers are restarted if their heartbeat file hasn't been touched for this long, once they've had the time to connect
+HEARTBEAT_TIMEOUT = 120
+
+# Restart delay after a worker exits, doubling (up to the maximum) while it keeps exiting soon after starting
+RESTART_DELAY = 5
+RESTART_DELAY_MAX = 5 * 60
+STABLE_UPTIME = 5 * 60
+
+workers = {}
+stopping = asyncio.Event()
+
+
+def split_shards(shard_count: int, process_count: int) -> List[List[int]]:
+    """Splits the shards into contiguous, evenly sized ranges, one per process."""
+    return [list(range(shard_count * i // process_count, shard_count * (i + 1) // process_count))
+            for i in range(process_count)]
+
+
+async def sleep_unless_stopping(delay: float):
+    try:
+        await asyncio.wait_for(stopping.wait(), timeout=delay)
+    except asyncio.TimeoutError:
+        pass
+
+
+def heartbeat_age(path: str) -> float:
+    try:
+        return time.time() - os.path.getmtime(path)
+    except OSError:
+        return float("inf")
+
+
+async def watch_worker(index: int, process, heartbeat_file: str, shard_ids: List[int]):
+    """Waits until the worker exits, or kills it once it stops sending heartbeats. Returns its exit code."""
+    started = time.monotonic()
+    startup_grace = 60 + IDENTIFY_INTERVAL * len(shard_ids)
+
+    while True:
+        try:
+            return await asyncio.wait_for(process.wait(), timeout=15)
+        except asyncio.TimeoutError:
+            pass
+
+        if time.monotonic() - started > startup_grace and heartbeat_age(heartbeat_file) > HEARTBEAT_TIMEOUT:
+            logger.warning("Worker {} (shards {}) stopped sending heartbeats, killing it".format(index, shard_ids))
+            process.kill()
+            return await process.wait()
+
+
+async def run_worker(index: int, shard_count: int, shard_ids: List[int], start_delay: float):
+    await sleep_unless_stopping(start_delay)
+
+    heartbeat_file = os.path.join(tempfile.gettempdir(), "pluralkit-shards-{}-{}".format(os.getpid(), index))
+    env = dict(os.environ, SHARD_COUNT=str(shard_count), SHARD_IDS="{}-{}".format(shard_ids[0], shard_ids[-1]),
+               SHARD_HEARTBEAT_FILE=heartbeat_file)
+
+    delay = RESTART_DELAY
+    while not stopping.is_set():
+        if os.path.exists(heartbeat_file):
+            os.remove(heartbeat_file)
+
+        logger.info("Starting worker {} (shards {}-{})".format(index, shard_ids[0], shard_ids[-1]))
+        started = time.monotonic()
+        process = await asyncio.create_subprocess_exec(sys.executable, BOT_MAIN, env=env)
+        workers[index] = process
+
+        exit_code = await watch_worker(index, process, heartbeat_file, shard_ids)
+        del workers[index]
+        if stopping.is_set():
+            break
+
+        # Back off from workers that crash right away (eg. because of a bad token or the database being down)
+        delay = RESTART_DELAY if time.monotonic() - started > STABLE_UPTIME else min(delay * 2, RESTART_DELAY_MAX)
+        logger.warning("Worker {} exited with code {}, restarting in {} seconds".format(index, exit_code, delay))
+        await sleep_unless_stopping(delay)
+
+    if os.path.exists(heartbeat_file):
+        os.remove(heartbeat_file)
+
+
+def stop():
+    stopping.set()
+
+    logger.info("Stopping {} workers".format(len(workers)))
+    for process in workers.values():
+        process.terminate()
+
+
+def main():
+    try:
+        shard_count = int(os.environ["SHARD_COUNT"])
+        process_count = int(os.environ.get("SHARD_PROCESSES") or os.cpu_count() or 1)
+        pool_size = int(os.environ.get("DATABASE_POOL_SIZE") or 10)
+        if shard_count < 1 or pool_size < 1:
+            raise ValueError()
+    except (KeyError, ValueError):
+        print("Please pass the total number of shards as SHARD_COUNT, and optionally the number of worker processes "
+              "as SHARD_PROCESSES and the database pool size per process as DATABASE_POOL_SIZE.", file=sys.stderr)
+        sys.exit(1)
+
+    process_count = max(1, min(process_count, shard_count))
+    loop = asyncio.get_event_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop)
+
+    tasks = []
+    start_delay = 0
+    for index, shard_ids in enumerate(split_shards(shard_count, process_count)):
+        tasks.append(run_worker(index, shard_count, shard_ids, start_delay))
+        start_delay += IDENTIFY_INTERVAL * len(shard_ids)
+
+    # Every worker has its own pool, plus a connection listening for invalidations
+    logger.info("Running {} shards in {} processes, using up to {} database connections".format(
+        shard_count, process_count, process_count * (pool_size + 1)))
+    loop.run_until_complete(asyncio.gather(*tasks))
+
+
+main()